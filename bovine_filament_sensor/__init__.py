@@ -1,18 +1,78 @@
 # coding=utf-8
 import flask
-import RPi.GPIO as GPIO
-from datetime import datetime
-from time import sleep
+import json
+import logging
+import math
+import os
+from collections import namedtuple
+from time import perf_counter
 from octoprint.plugin import StartupPlugin, AssetPlugin, EventHandlerPlugin
+from octoprint.plugin import ShutdownPlugin
 from octoprint.plugin import TemplatePlugin, SettingsPlugin, SimpleApiPlugin
 from octoprint.events import Events
 from .timeout_detection import TimeoutDetector
-from .detection_data import DetectionData
-
-
-class BovineFilamentSensorPlugin(StartupPlugin, EventHandlerPlugin,
+from .adaptive_timeout import AdaptiveTimeout
+from .detection_data import DetectionData, StatusSnapshot
+from .ui_publisher import UIPublisher
+from .gcode import MOVE_COMMANDS, STATE_COMMANDS, extract_e
+from .scheduler import DeadlineScheduler
+from .sensor import FilamentSensor
+from .flow_rate import FlowRateMonitor
+from .distance_engine import DistanceEngine
+from .calibration import Calibration
+from .health import SensorHealth
+from .fusion import DetectionFusion
+from .response_dispatcher import ResponseDispatcher
+from .response_dispatcher import PauseAction, BellAction, RemoteAlarmAction
+from .gpio_backend import create_backend, available_backends
+from .gcode_index import GcodeIndexer
+from . import telemetry
+from .telemetry import TelemetryRing
+from .metrics import Metrics, MICRO_BUCKETS
+from .hook_budget import HookBudget
+from .state_pipeline import StatePipeline
+from .clock import MONOTONIC
+
+
+SettingsSnapshot = namedtuple("SettingsSnapshot", (
+    "gpio_backend", "gpio_chip", "sampler_segment", "sampler_socket",
+    "mode", "sensor_enabled", "sensor_pin",
+    "debounce",  # seconds
+    "tool_pins",  # ((tool, pin), ...) of all the sensors
+    "detection_method",
+    "timeout_detection", "distance_detection",  # engines of the method
+    "fusion_votes",  # engines that must agree before a pause
+    "z_event_number", "detection_distance", "max_idle_time",
+    "adaptive_timeout", "adaptive_pulses", "min_idle_time",
+    "pause_command", "alarm_pin", "alarm_url", "ui_max_rate",
+    "flow_detection", "mm_per_pulse", "flow_window", "flow_min_ratio",
+    "pulse_counting",  # distance detection credits mm_per_pulse per edge
+    "gcode_index",
+    "hook_budget",  # seconds per G-code line, 0 = no guard
+    "gcode_hook",  # the G-code hook has something to do
+))
+
+
+class BovineFilamentSensorPlugin(StartupPlugin, ShutdownPlugin,
+                                 EventHandlerPlugin,
                                  TemplatePlugin, SettingsPlugin,
                                  AssetPlugin, SimpleApiPlugin):
+    # Seconds between two copies of the sensor edges to the telemetry ring
+    TELEMETRY_INTERVAL = 0.5
+    # Seconds between two updates of the sensor health
+    HEALTH_INTERVAL = 2.0
+    # One G-code line out of HOOK_SAMPLE is timed (power of two)
+    HOOK_SAMPLE = 8
+    # Under load: moves are accounted every BATCH_LINES lines and one
+    # timed line out of LOG_SAMPLE is logged (power of two)
+    BATCH_LINES = 16
+    LOG_SAMPLE = 8
+    # Lowest nozzle temperature for the calibration extrusion (Marlin's
+    # EXTRUDE_MINTEMP) and seconds to wait for its first sensor edge
+    CALIBRATION_MIN_TEMP = 170
+    CALIBRATION_TIMEOUT = 10
+    # Longest wait of a status long-poll (?since=<version>), in seconds
+    LONG_POLL = 30.0
 
     def __init__(self):
         self.print_started = False
@@ -22,119 +82,501 @@ class BovineFilamentSensorPlugin(StartupPlugin, EventHandlerPlugin,
         self.z_changes = 0
         self.START_DISTANCE_OFFSET = 7
         self.response_sent = False
-        self.sensor_thread = None
+        self.sensor_detector = None
+        self._detecting = False     # between sensor_start and a pause or end
+        self._calibration = None
+        self._scheduler = None
+        self._pipeline = None   # single writer of the detection state
+        self._responses = None
+        self._indexer = None
+        self._job_path = None   # file of the current job on disk
+        self._telemetry = None
+        self._telemetry_poll = None
+        self._health_poll = None
+        self._health_warnings = {}
+        self._pause_ignored = False     # recorded since the last movement
+        self._sensors = {}
+        self._sensor = None     # sensor of the active tool
+        self._gpio = None
+        self._flow_active = False
         self._data = None
+        self._publisher = None
+        self._cfg = None
+        self._debug = False
+        self._hook_calls = 0
+        self._log_debug = False     # debug logging enabled for the plugin
+        self._batch_e = 0.0         # E accumulated in the degraded mode
+        self._batch_lines = 0
+        self._budget = HookBudget(0, self._queued(self.hook_mode_changed))
+        # Single path from the verdicts of the engines to the response
+        self._fusion = DetectionFusion(1, self.raise_emergency_response)
+        self._clock = MONOTONIC     # a VirtualClock in simulations
+        self._setup_metrics()
 
     @property
     def sensor_pin(self):
-        return int(self._settings.get(["sensor_pin"]))
+        return self._cfg.sensor_pin
 
     @property
-    def sensor_pause_print(self):
-        return self._settings.get_boolean(["sensor_pause_print"])
+    def sensor_enabled(self):
+        return self._cfg.sensor_enabled
 
     @property
     def detection_method(self):
-        return int(self._settings.get(["detection_method"]))
-
-    @property
-    def sensor_enabled(self):
-        return self._settings.get_boolean(["sensor_enabled"])
+        return self._cfg.detection_method
 
     @property
     def pause_command(self):
-        return self._settings.get(["pause_command"])
+        return self._cfg.pause_command
 
     @property
     def mode(self):
-        return int(self._settings.get(["mode"]))
+        return self._cfg.mode
 
     # Distance detection
     @property
     def detection_distance(self):
-        return int(self._settings.get(["detection_distance"]))
+        return self._cfg.detection_distance
 
     # Timeout detection
     @property
     def max_idle_time(self):
-        return int(self._settings.get(["max_idle_time"]))
+        return self._cfg.max_idle_time
 
     # Movements before Start sensor
     @property
     def z_event_number(self):
-        return int(self._settings.get(["z_events_number"]))
+        return self._cfg.z_event_number
+
+    # Maximum number of UI updates per second
+    @property
+    def ui_max_rate(self):
+        return self._cfg.ui_max_rate
+
+    def _setup_metrics(self):
+        """Allocate the metrics served by on_api_get."""
+        m = self._metrics = Metrics()
+        self._m_hook = m.histogram(
+            "hook_seconds", "Time of the G-code hook on the printer "
+            "communication thread (sampled 1 in %i lines)" % self.HOOK_SAMPLE,
+            MICRO_BUCKETS)
+        m.collected("state_queue_length", "State changes waiting for the "
+                    "state pipeline", "gauge",
+                    lambda: [({}, self._pipeline.pending()
+                              if self._pipeline else 0)])
+        m.collected("edges_total", "Sensor edges received", "counter",
+                    lambda: [({"tool": sensor.tool}, sensor.edges.count)
+                             for sensor in self._sensors.values()])
+        m.collected("edges_dropped_total", "Sensor edges overwritten before "
+                    "they were read", "counter",
+                    lambda: [({"tool": sensor.tool}, sensor.edges.dropped)
+                             for sensor in self._sensors.values()])
+        m.collected("edges_rejected_total", "Sensor edges rejected as bounces "
+                    "(filters in user space only)", "counter",
+                    lambda: [({"tool": sensor.tool}, sensor.edges.rejected)
+                             for sensor in self._sensors.values()])
+        self._m_edge = m.histogram(
+            "edge_delivery_seconds", "Time from a sensor edge to its delivery "
+            "by the GPIO backend (kernel timestamped backends only)")
+        self._m_jitter = m.histogram(
+            "detector_jitter_seconds", "Lateness of the timeout detector checks")
+        self._m_ui_messages = m.counter("ui_messages_total",
+                                        "Plugin messages sent to the UI")
+        self._m_ui_bytes = m.counter("ui_bytes_total",
+                                     "JSON bytes of the UI messages")
+        self._m_ui_json = m.histogram(
+            "ui_json_seconds", "Time to serialize a UI message", MICRO_BUCKETS)
+        m.collected("sensor_duty_cycle", "Moving average of the duty cycle "
+                    "of the sensor", "gauge",
+                    lambda: [({"tool": sensor.tool}, sensor.health.duty_cycle)
+                             for sensor in self._sensors.values()
+                             if sensor.health.duty_cycle is not None])
+        m.collected("sensor_health_warnings", "Health problems of the sensor",
+                    "gauge",
+                    lambda: [({"tool": sensor.tool}, len(
+                        self._health_warnings.get("T%i" % sensor.tool, ())))
+                             for sensor in self._sensors.values()])
+        m.collected("hook_degraded", "1 while the G-code hook runs in the "
+                    "cheaper mode", "gauge",
+                    lambda: [({}, int(self._budget.degraded))])
+        m.collected("hook_mode_changes_total", "Changes of the G-code hook "
+                    "mode", "counter", lambda: [({}, self._budget.changes)])
+        self._m_dispatch = m.histogram(
+            "response_dispatch_seconds", "Time from a detection to the start "
+            "of its response (e.g. the pause command sent to the printer)")
+
+    def _load_settings(self):
+        """Take a snapshot of the settings.
+
+        The G-code hook runs for every line sent to the printer, so it only
+        reads this snapshot, which is rebuilt when the settings are saved.
+        """
+        detection_method = int(self._settings.get(["detection_method"]))
+        timeout_detection = detection_method in (0, 2)
+        distance_detection = detection_method in (1, 2)
+        sensor_enabled = self._settings.get_boolean(["sensor_enabled"])
+        flow_detection = self._settings.get_boolean(["flow_detection"])
+        adaptive_timeout = self._settings.get_boolean(["adaptive_timeout"])
+        sensor_pin = int(self._settings.get(["sensor_pin"]))
+        tool_pins = [(0, sensor_pin)]
+        for sensor in self._settings.get(["extra_sensors"]) or []:
+            try:
+                tool, pin = int(sensor["tool"]), int(sensor["pin"])
+            except (KeyError, TypeError, ValueError):
+                # e.g. a row added in the settings and left empty
+                self._logger.warn("Ignoring the sensor %r: the tool and "
+                                  "the pin must be numbers" % (sensor,))
+                continue
+            if any(tool == t or pin == p for t, p in tool_pins):
+                self._logger.warn("Ignoring the sensor of T%i on pin %i: "
+                                  "tool or pin already used" % (tool, pin))
+                continue
+            tool_pins.append((tool, pin))
+        self._cfg = SettingsSnapshot(
+            gpio_backend=self._settings.get(["gpio_backend"]),
+            gpio_chip=self._settings.get(["gpio_chip"]),
+            sampler_segment=self._settings.get(["sampler_segment"]),
+            sampler_socket=self._settings.get(["sampler_socket"]),
+            mode=int(self._settings.get(["mode"])),
+            sensor_enabled=sensor_enabled,
+            sensor_pin=sensor_pin,
+            debounce=float(self._settings.get(["debounce_time"])) / 1000.0,
+            tool_pins=tuple(tool_pins),
+            detection_method=detection_method,
+            timeout_detection=timeout_detection,
+            distance_detection=distance_detection,
+            # Alone, each engine pauses on its own verdict
+            fusion_votes=(int(self._settings.get(["fusion_votes"]))
+                          if detection_method == 2 else 1),
+            z_event_number=int(self._settings.get(["z_events_number"])),
+            detection_distance=int(self._settings.get(["detection_distance"])),
+            max_idle_time=int(self._settings.get(["max_idle_time"])),
+            adaptive_timeout=adaptive_timeout,
+            adaptive_pulses=float(self._settings.get(["adaptive_pulses"])),
+            min_idle_time=float(self._settings.get(["min_idle_time"])),
+            pause_command=self._settings.get(["pause_command"]),
+            alarm_pin=int(self._settings.get(["alarm_pin"])),
+            alarm_url=self._settings.get(["alarm_url"]),
+            ui_max_rate=float(self._settings.get(["ui_max_rate"])),
+            flow_detection=flow_detection,
+            mm_per_pulse=float(self._settings.get(["mm_per_pulse"])),
+            flow_window=float(self._settings.get(["flow_window"])),
+            flow_min_ratio=float(self._settings.get(["flow_min_ratio"])),
+            pulse_counting=self._settings.get_boolean(["pulse_counting"]),
+            gcode_index=self._settings.get_boolean(["gcode_index"]),
+            hook_budget=float(self._settings.get(["hook_budget"])) * 1e-6,
+            # Tool changes are followed when there are several sensors
+            gcode_hook=sensor_enabled and (distance_detection or
+                                           flow_detection or
+                                           adaptive_timeout or
+                                           len(tool_pins) > 1),
+        )
+        cfg = self._cfg
+        self._fusion.votes = cfg.fusion_votes
+        self._fusion.set_engines(
+            [reason for reason, enabled in (
+                (telemetry.TIMEOUT, cfg.timeout_detection),
+                (telemetry.DISTANCE, cfg.distance_detection),
+                (telemetry.FLOW, cfg.flow_detection)) if enabled])
+        self._log_debug = self._logger.isEnabledFor(logging.DEBUG)
+        self._debug = self._log_debug and not self._budget.degraded
+        self._budget.budget = self._cfg.hook_budget
 
     def get_settings_defaults(self):
         """Plugin's default settings (SettingsPlugin mixin)."""
         self._logger.info("Get_settings_defaults")
         return dict(
             # Motion sensor
+            gpio_backend="rpi",  # rpi/gpiod = RPi.GPIO/GPIO character device
+            gpio_chip="/dev/gpiochip0",  # Character device of the gpiod backend
+            # Shared memory segment and command socket of the sampler daemon
+            # (sampler backend), the socket is only needed for the bell
+            sampler_segment="bovine_sampler",
+            sampler_socket="",
             mode=1,  # BCM Mode
             sensor_enabled=True,  # Sensor detection is enabled by default
-            sensor_pin=24,  #
-            detection_method=0,  # 0/1 = timeout/distance detection
-            z_event_number=3,  # counts printer movements before actual printing
+            sensor_pin=24,  # Sensor of the first tool (T0)
+            # Edges closer than this (ms) to the previous one are bounces
+            debounce_time=1,
+            # Sensors of other tools: [{"tool": 1, "pin": 25}, ...]
+            extra_sensors=[],
+            # 0/1 = timeout/distance detection, 2 = both (fused)
+            detection_method=0,
+            # Fused detection: engines that must agree to pause the print
+            fusion_votes=2,
+            z_events_number=3,  # counts printer movements before actual printing
 
             # Distance detection
             # Recommended detection distance from Marlin would be 7
             detection_distance=15,
+            # Credit mm_per_pulse of filament per sensor edge instead of
+            # the whole detection distance (set by the calibration)
+            pulse_counting=False,
 
             # Timeout detection
             # Maximum time no movement is detected - default continously
             max_idle_time=45,
+            # Adaptive timeout: pause once the filament commanded since the
+            # last edge should have given adaptive_pulses edges, not before
+            # min_idle_time seconds (max_idle_time is the ceiling)
+            adaptive_timeout=False,
+            adaptive_pulses=5,
+            min_idle_time=5,
 
             pause_command="M600",
+            alarm_pin=21,  # GPIO output of the local bell ("@Mu" command)
+            alarm_url="",  # Remote alarm triggered with a GET, if not empty
+
+            # Flow rate detection (runs along with the selected method)
+            # Pauses when the filament measured by the sensor stays below
+            # flow_min_ratio times the commanded one over flow_window seconds
+            flow_detection=False,
+            mm_per_pulse=1.0,  # filament length per sensor edge
+            # Calibration: extrude calibration_length mm at
+            # calibration_feedrate mm/min and count the sensor edges
+            calibration_length=100,
+            calibration_feedrate=100,
+            flow_window=10,
+            flow_min_ratio=0.5,
+
+            # Index G-code files to ignore planned pauses in timeout detection
+            gcode_index=True,
+
+            # UI updates are coalesced and sent at most this many times per second
+            ui_max_rate=5,
+
+            # Average G-code hook time per line (us) above which it degrades
+            # to batched extrusion, no UI updates and sampled logging
+            hook_budget=20,
         )
 
     def initialize(self):
+        self._load_settings()
         self._logger.info("Initialize: Instantiate DetectionData")
+        self._budget.clock = self._clock
+        self._scheduler = DeadlineScheduler(self._logger, clock=self._clock)
+        self._scheduler.start()
+        self._responses = ResponseDispatcher(self._logger, self._scheduler,
+                                             latency=self._m_dispatch)
+        self._indexer = GcodeIndexer(
+            os.path.join(self.get_plugin_data_folder(), "gcode_index"),
+            self._logger)
+        self._publisher = UIPublisher(self.send_ui_message, self._scheduler,
+                                      self.ui_max_rate)
         self._data = DetectionData(self.detection_distance, True,
-                                   self.update_ui)
+                                   self._publisher.publish)
+        self._telemetry = TelemetryRing(
+            os.path.join(self.get_plugin_data_folder(), "telemetry.ring"),
+            clock=self._clock)
+        self._telemetry_poll = self._scheduler.deadline(self.record_edges)
+        self._health_poll = self._scheduler.deadline(self.check_health)
+        self._pipeline = StatePipeline(self._logger, self.status_snapshot,
+                                       clock=self._clock)
+        self._pipeline.start()
 
     def on_after_startup(self):
-        self._logger.info("Running RPi.GPIO version '%s'" % GPIO.VERSION)
-
-        if GPIO.VERSION < "0.6":    # Need >= 0.6 for edge detection
-            raise Exception("RPi.GPIO must be greater than 0.6")
-        GPIO.setwarnings(False)     # Disable GPIO warnings
-
-        self._setup_sensor()
+        self._pipeline.call(self._setup_gpio)
+
+    def on_shutdown(self):
+        self._pipeline.call(self.sensor_stop_detector)
+        self._pipeline.stop()
+        self._responses.stop()
+        self._indexer.stop()
+        self._telemetry_poll.cancel()
+        self._health_poll.cancel()
+        self._remove_sensors()
+        self._gpio.close()
+        self._publisher.cancel()
+        self._scheduler.stop()
+        self._telemetry.close()
 
     # Initialization methods
-    def _setup_sensor(self):
-        """"""
-        self._logger.info("Setting up sensor data")
-        # Clean up before intializing again (ports could already be in use)
-        if self.mode == 0:
-            self._logger.info("Using Board Mode")
-            GPIO.setmode(GPIO.BOARD)
-        else:
-            self._logger.info("Using BCM Mode")
-            GPIO.setmode(GPIO.BCM)
-
-        GPIO.setup(self.sensor_pin, GPIO.IN)
+    def _setup_gpio(self):
+        reattach = self._setup_backend()
+        self._setup_sensors(reattach=reattach)
 
-        # Add reset_distance if detection_method is distance_detection
-        if self.detection_method == 1:
-            # Remove event first, because it might have been in use already
-            try:
-                GPIO.remove_event_detect(self.sensor_pin)
-            except ValueError:
-                self._logger.warn("Pin %i not used before" % self.sensor_pin)
-
-            GPIO.add_event_detect(self.sensor_pin, GPIO.BOTH,
-                                  callback=self.reset_distance)
+    def _setup_backend(self):
+        """Create the GPIO backend, or replace it if the settings changed.
 
-        if not self.sensor_enabled:
-            self._logger.info("Motion sensor is deactivated")
+        Returns True if the sensors must be attached to a new backend.
+        """
+        cfg = self._cfg
+        if self._gpio is not None:
+            gpio = self._gpio
+            if (gpio.name == cfg.gpio_backend and
+                    getattr(gpio, "chip", cfg.gpio_chip) == cfg.gpio_chip and
+                    getattr(gpio, "segment", cfg.sampler_segment) ==
+                    cfg.sampler_segment and
+                    getattr(gpio, "socket_path", cfg.sampler_socket) ==
+                    cfg.sampler_socket):
+                return False
+            # The sensors and their edge buffers are kept for the new one
+            for sensor in self._sensors.values():
+                self._gpio.remove_edge_detection(sensor.pin)
+            self._gpio.close()
+        self._logger.info("Using GPIO backend '%s'" % cfg.gpio_backend)
+        self._gpio = create_backend(cfg.gpio_backend, self._logger,
+                                    chip=cfg.gpio_chip, clock=self._clock,
+                                    segment=cfg.sampler_segment,
+                                    socket_path=cfg.sampler_socket)
+        self._gpio.edge_latency = self._m_edge
+        return True
+
+    def _new_sensor(self, tool, pin):
+        cfg = self._cfg
+        sensor = FilamentSensor(tool, pin)
+        # Also tracks the commanded filament for the adaptive timeout
+        sensor.flow = FlowRateMonitor(
+            sensor.edges, cfg.mm_per_pulse, cfg.flow_window,
+            cfg.flow_min_ratio,
+            callback=self.flow_slip_callback if cfg.flow_detection else None,
+            recovered=self.flow_recovered if cfg.flow_detection else None,
+            clock=self._clock)
+        sensor.distance = DistanceEngine(
+            cfg.detection_distance,
+            cfg.mm_per_pulse if cfg.pulse_counting else None)
+        return sensor
+
+    def _setup_sensors(self, old=None, reattach=False):
+        """Attach the sensors to their GPIO lines.
+
+        Only the lines whose pin, numbering mode or debounce time changed
+        since the settings ``old`` are set up again, on the same edge
+        buffer, so the detectors reading it keep their state. All of them
+        are with ``reattach`` (new backend) or without ``old``.
+        """
+        cfg = self._cfg
+        gpio = self._gpio
+        if old is None or old.mode != cfg.mode:
+            self._logger.info("Using %s Mode" % ("Board" if cfg.mode == 0
+                                                 else "BCM"))
+        redo = (reattach or old is None or old.mode != cfg.mode or
+                old.debounce != cfg.debounce)
+        pins = dict(cfg.tool_pins)
+        sensors = dict(self._sensors)
+        # Release first, tools may swap their pins
+        attach = []
+        for tool, sensor in list(sensors.items()):
+            if pins.get(tool) == sensor.pin and not redo:
+                continue
+            if not reattach:
+                gpio.remove_edge_detection(sensor.pin)
+            if tool in pins:
+                attach.append(sensor)
+            else:
+                del sensors[tool]
+                self._logger.info("Removed the sensor of tool T%i" % tool)
+        if redo:
+            gpio.set_mode(cfg.mode)
+
+        for tool, pin in cfg.tool_pins:
+            sensor = sensors.get(tool)
+            if sensor is None:
+                sensor = sensors[tool] = self._new_sensor(tool, pin)
+                attach.append(sensor)
+            moved = sensor.pin != pin or sensor.health is None
+            if sensor not in attach:
+                continue
+            sensor.pin = pin
+            gpio.add_edge_detection(pin, sensor.edges, cfg.debounce)
+            if moved:
+                # Another line, another sensor to watch
+                sensor.health_edges.skip()
+                sensor.health = SensorHealth(gpio.input(pin))
+            self._logger.info("Sensor of tool T%i on pin %i" % (tool, pin))
+
+        # The dict is only published when complete, other threads iterate
+        # over it
+        self._sensors = sensors
+        # None while the active tool has no sensor
+        sensor = sensors.get(self._data.active_tool)
+        if sensor is not self._sensor:
+            # The sensor of the active tool was removed or added
+            self._sensor = sensor
+            self._restart_timeout_detector()
+        self._health_poll.arm(self.HEALTH_INTERVAL)
+        if old is None:
+            if not cfg.sensor_enabled:
+                self._logger.info("Motion sensor is deactivated")
+            self._data.filament_moving = False
+            self._data.remaining_distance = self.detection_distance
 
-        self._data.filament_moving = False
-        self.sensor_thread = None
-        self._data.remaining_distance = self.detection_distance
+    def _remove_sensors(self):
+        for sensor in self._sensors.values():
+            self._gpio.remove_edge_detection(sensor.pin)
+        self._sensors = {}
+        self._sensor = None
 
     def on_settings_save(self, data):
         SettingsPlugin.on_settings_save(self, data)
-        self._setup_sensor()
+        self._pipeline.call(self._apply_settings)
+
+    def _apply_settings(self):
+        """Apply the saved settings to the running detection.
+
+        Only what changed is set up again: GPIO lines when their backend,
+        pin, mode or debounce time changed, and the engines and detectors
+        take new thresholds over with their state, so settings can be tuned
+        during a print without a window where the detection is blind.
+        """
+        old = self._cfg
+        self._load_settings()
+        cfg = self._cfg
+        changed = set(field for field in SettingsSnapshot._fields
+                      if getattr(old, field) != getattr(cfg, field))
+        if not changed:
+            return
+        self._logger.info("Settings changed: %s" % ", ".join(sorted(changed)))
+        self._publisher.max_rate = self.ui_max_rate
+        reattach = self._setup_backend()
+        self._setup_sensors(old, reattach)
+
+        for sensor in self._sensors.values():
+            flow = sensor.flow
+            flow.mm_per_pulse = cfg.mm_per_pulse
+            flow.min_ratio = cfg.flow_min_ratio
+            flow.callback = (self.flow_slip_callback if cfg.flow_detection
+                             else None)
+            flow.recovered = self.flow_recovered if cfg.flow_detection else None
+            if cfg.flow_window != old.flow_window:
+                flow.set_window(cfg.flow_window)
+            sensor.distance.configure(
+                cfg.detection_distance,
+                cfg.mm_per_pulse if cfg.pulse_counting else None)
+        if self._sensor is not None:
+            self._data.remaining_distance = self._sensor.distance.remaining
+
+        if not cfg.sensor_enabled:
+            if self._detecting:
+                self._logger.info("Motion sensor is deactivated")
+                self.sensor_stop_detector()
+                self._flow_active = False
+                self._detecting = False
+            return
+        if not self._detecting:
+            if not old.sensor_enabled and self._printer.is_printing():
+                self.sensor_start()
+            return
+
+        # Engines turned on or off while the sensor runs
+        detector = self.sensor_detector
+        timeout_running = (detector is not None and
+                           detector.name == "TimeoutDetection")
+        if timeout_running and not cfg.timeout_detection:
+            self.sensor_stop_detector()
+        elif timeout_running:
+            detector.max_idle_time = cfg.max_idle_time
+            detector.adaptive = self._adaptive_timeout(detector.adaptive)
+            detector.reschedule()
+        if cfg.distance_detection and not old.distance_detection:
+            self.init_distance_detection()
+        track_flow = self._track_flow()
+        if track_flow and not self._flow_active and self._sensor is not None:
+            self._sensor.flow.reset()
+        self._flow_active = track_flow
+        if (cfg.timeout_detection and self.sensor_detector is None and
+                self._sensor is not None):
+            self._start_timeout_detector()
 
     def get_template_configs(self):
         return [dict(type="settings", custom_bindings=True)]
@@ -150,9 +592,9 @@ class BovineFilamentSensorPlugin(StartupPlugin, EventHandlerPlugin,
 
     def stop_connection_test(self):
         """Connection tests"""
-        if self.sensor_thread is not None and self.sensor_thread.name == "ConnectionTest":
-            self.sensor_thread.keep_running = False
-            self.sensor_thread = None
+        if self.sensor_detector is not None and self.sensor_detector.name == "ConnectionTest":
+            self.sensor_detector.stop()
+            self.sensor_detector = None
             self._data.connection_test_running = False
             self._logger.info("Connection test stopped")
         else:
@@ -161,13 +603,14 @@ class BovineFilamentSensorPlugin(StartupPlugin, EventHandlerPlugin,
     def start_connection_test(self):
         """Connection tests"""
         CONNECTION_TEST_TIME = 2
-        if self.sensor_thread is None:
-            self.sensor_thread = TimeoutDetector(1, "ConnectionTest",
-                                                 self.sensor_pin,
-                                                 CONNECTION_TEST_TIME,
-                                                 self._logger, self._data,
-                                                 callback=self.connection_test_callback)
-            self.sensor_thread.start()
+        if self.sensor_detector is None:
+            sensor = self._sensor or self._sensors[0]
+            self.sensor_detector = TimeoutDetector(
+                "ConnectionTest", sensor.edges, CONNECTION_TEST_TIME,
+                self._logger, self._pipeline.writer(self._data),
+                self._scheduler,
+                callback=self._queued(self.connection_test_callback))
+            self.sensor_detector.start()
             self._data.connection_test_running = True
             self._logger.info("Connection test started")
 
@@ -181,51 +624,126 @@ class BovineFilamentSensorPlugin(StartupPlugin, EventHandlerPlugin,
                 self._logger.debug("GPIO mode: Board Mode")
             else:
                 self._logger.debug("GPIO mode: BCM Mode")
-            self._logger.debug("GPIO pin: %s" % self.sensor_pin)
+            self._logger.debug("GPIO pin: %s" % (self._sensor.pin if self._sensor
+                                                 else "none"))
+
+            # Before the timeout detector, which reads the commanded filament
+            if self._track_flow():
+                self._logger.debug("Flow tracking: %.2f mm/pulse",
+                                   self._cfg.mm_per_pulse)
+                if self._sensor is not None:
+                    self._sensor.flow.reset()
+                self._flow_active = True
+
+            self._fusion.reset()
 
             # Distance detection
-            if self.detection_method == 1:
+            if self._cfg.distance_detection:
                 self._logger.debug("Detection Mode: Distance")
                 self._logger.debug("Distance: %s" % self.detection_distance)
 
-            # Timeout detection
-            elif self.detection_method == 0 and self.sensor_thread is None:
+            # Timeout detection, also along the distance one (fused)
+            if self._cfg.timeout_detection and self.sensor_detector is None:
                 self._logger.debug("Detection Mode: Timeout")
                 self._logger.debug("Timeout: %s" % self.max_idle_time)
-
-                self.sensor_thread = TimeoutDetector(
-                    1, "TimeoutDetectionThread",
-                    self.sensor_pin,
-                    self.max_idle_time,
-                    self._logger, self._data,
-                    callback=self.raise_emergency_response
-                )
-                self.sensor_thread.start()
-                self._logger.info("Motion sensor started: Timeout detection")
+                self._start_timeout_detector()
 
             self.response_sent = False
             self._data.filament_moving = True
+            self._detecting = True
+
+    def _track_flow(self):
+        """The commanded filament is needed (flow rate or adaptive timeout)."""
+        cfg = self._cfg
+        return cfg.flow_detection or (cfg.timeout_detection and
+                                      cfg.adaptive_timeout)
+
+    def _start_timeout_detector(self):
+        """Watch the sensor of the active tool on the shared scheduler."""
+        if self._sensor is None:
+            return
+        adaptive = self._adaptive_timeout()
+        self.sensor_detector = TimeoutDetector(
+            "TimeoutDetection",
+            self._sensor.edges,
+            self.max_idle_time,
+            self._logger, self._pipeline.writer(self._data),
+            self._scheduler,
+            callback=self._queued(self.timeout_detection_callback),
+            quiet=self.planned_quiet_time,
+            jitter=self._m_jitter,
+            adaptive=adaptive
+        )
+        self.sensor_detector.start()
+        self._logger.info("Motion sensor started: Timeout detection on T%i"
+                          % self._sensor.tool)
+
+    def _adaptive_timeout(self, current=None):
+        """AdaptiveTimeout of the active sensor, ``current`` if it exists."""
+        cfg = self._cfg
+        if not cfg.adaptive_timeout or self._sensor is None:
+            return None
+        if current is not None:
+            # Keep the filament counted since the last edge
+            current.pulses = cfg.adaptive_pulses
+            current.floor = cfg.min_idle_time
+            return current
+        return AdaptiveTimeout(self._sensor.flow, cfg.adaptive_pulses,
+                               cfg.min_idle_time)
+
+    def _restart_timeout_detector(self):
+        """Move the timeout detection to the active sensor."""
+        detector = self.sensor_detector
+        if detector is None:
+            # Not running, or the previous tool had no sensor to watch
+            if not (self._detecting and self._cfg.timeout_detection):
+                return
+        elif detector.name == "TimeoutDetection":
+            self.sensor_stop_detector()
+        else:
+            return
+        self._start_timeout_detector()
+
+    def select_tool(self, tool):
+        """Switch the monitored sensor on a tool change."""
+        old = self._sensor
+        if old is not None:
+            if old.tool == tool:
+                return
+        self._sensor = sensor = self._sensors.get(tool)
+        self._data.active_tool = tool
+        if sensor is None:
+            self._logger.info("Tool T%i has no filament sensor" % tool)
+        else:
+            self._logger.info("Monitoring sensor of tool T%i" % tool)
 
-    # Stop the motion_sensor thread
-    def sensor_stop_thread(self):
-        if self.sensor_thread is not None:
-            self.sensor_thread.keep_running = False
-            self.sensor_thread = None
+        # The E position of the new tool is picked up on its first move
+        self.last_e = -1
+        if sensor is not None:
+            sensor.distance_edges.skip()
+            self.last_movement_time = self._clock.monotonic()
+            self._data.remaining_distance = sensor.distance.remaining
+            if self._flow_active:
+                sensor.flow.reset()
+
+        self._restart_timeout_detector()
+
+    # Stop the motion sensor detector
+    def sensor_stop_detector(self):
+        if self.sensor_detector is not None:
+            self.sensor_detector.stop()
+            self.sensor_detector = None
             self._logger.info("Motion sensor stopped")
 
-    def ring_bell(self):
-        PIN = 21
-        GPIO.setup(PIN, GPIO.OUT)
-        for n in range(25):
-            GPIO.output(PIN, True)  # Turn OFF LED
-            sleep(1)
-            GPIO.output(PIN, False)  # Turn ON LED
-            sleep(0.5)
-
-    # noinspection PyUnusedLocal
-    def raise_emergency_response(self, dummy):
+    def raise_emergency_response(self, reason):
         """Raise configured response to interrupt the print (Sensor callback).
+
+        The actions are only queued in the response dispatcher, so the
+        detection threads never block on them. ``reason`` is the detection
+        (telemetry.TIMEOUT, DISTANCE or FLOW) recorded with the decision.
         """
+        self._telemetry.record(telemetry.PAUSE, reason,
+                               0 if self.response_sent else 1)
         # Check if stop signal was already sent
         if not self.response_sent:
             self._logger.error("Motion sensor detected no movement")
@@ -233,42 +751,62 @@ class BovineFilamentSensorPlugin(StartupPlugin, EventHandlerPlugin,
 
             if self.pause_command == "@Mu":
                 self._logger.info("Muuuuuuuuu!!!!")
-                self.ring_bell()
+                self._responses.dispatch(BellAction(self._gpio,
+                                                   self._cfg.alarm_pin))
             else:
-                self._printer.commands(self.pause_command)
+                self._responses.dispatch(PauseAction(self._printer,
+                                                     self.pause_command))
+            if self._cfg.alarm_url:
+                self._responses.dispatch(RemoteAlarmAction(self._cfg.alarm_url))
 
             self.response_sent = True
             self._data.filament_moving = False
             self.last_e = -1  # Set to -1, so it ignores the first test then continues
 
-    # noinspection PyUnusedLocal
-    def reset_distance(self, pin):
-        """Reset remaining distance if smaller than the new value"""
-        self._logger.debug("Motion sensor reset detection distance")
+    def reset_distance(self, last_edge):
+        """The sensor moved: cancel a pending response."""
+        self._fusion.cleared(telemetry.DISTANCE)
+        if self.response_sent:
+            self._responses.cancel()
+            self._telemetry.record(telemetry.RESUME, telemetry.DISTANCE, 0,
+                                   last_edge)
         self.response_sent = False
-        self.last_movement_time = datetime.now()
-        if self._data.remaining_distance < self.detection_distance:
-            self._data.remaining_distance = self.detection_distance
-            self._data.filament_moving = True
+        self._pause_ignored = False
+        self.last_movement_time = last_edge
+        self._data.filament_moving = True
 
     def init_distance_detection(self):
         """Initialize the distance detection values"""
         self.last_e = -1.0
         self.current_e = 0.0
-        self.reset_remaining_distance()
+        self.last_movement_time = self._clock.monotonic()
+        for sensor in self._sensors.values():
+            sensor.distance_edges.skip()
+            sensor.distance.reset(self.START_DISTANCE_OFFSET)
+        if self._sensor is not None:
+            self._data.remaining_distance = self._sensor.distance.remaining
 
     def reset_remaining_distance(self):
         """ Reset the remaining distance on start or resume.
         START_DISTANCE_OFFSET is used for the (re-)start sequence.
 
         """
-        self._data.remaining_distance = (self.detection_distance +
-                                         self.START_DISTANCE_OFFSET)
+        if self._sensor is None:
+            return
+        self._sensor.distance.reset(self.START_DISTANCE_OFFSET)
+        self._data.remaining_distance = self._sensor.distance.remaining
 
     def calc_distance(self, read_e):
-        """Calculate the remaining distance"""
-        if self.detection_method == 1:
-            remaining_distance = self._data.remaining_distance
+        """Account a move in the distance engine of the active sensor"""
+        if self._cfg.distance_detection:
+            sensor = self._sensor
+            engine = sensor.distance
+            edges = sensor.distance_edges.read()
+            if edges:
+                engine.measured(len(edges))
+                self.reset_distance(edges[-1])
+
+            remaining_distance = engine.remaining
             # First check if need continue after last move
             if remaining_distance > 0:
 
@@ -287,63 +825,285 @@ class BovineFilamentSensorPlugin(StartupPlugin, EventHandlerPlugin,
                     self.current_e = read_e
 
                     delta_e = self.current_e - self.last_e
-                    rounded_delta = round(delta_e, 3)
-                    self._logger.debug(
-                        "CurrentE: %s - LastE: %s = %s" % (self.current_e, self.last_e, rounded_delta))
+                    if self._debug:
+                        self._logger.debug("CurrentE: %s - LastE: %s = %s",
+                                           self.current_e, self.last_e,
+                                           round(delta_e, 3))
 
                 # delta_e is just position if relative extrusion
                 else:
-                    delta_e = float(read_e)
-                    rounded_delta = round(delta_e, 3)
-                    self._logger.debug(
-                        "Relative Extrusion = %s" % rounded_delta)
-
-                if delta_e > self.detection_distance:
-                    # Calculate the deltaDistance modulo the detection_distance
-                    # Sometimes the polling of M114 is inaccurate so that with the next poll
-                    # very high distances are put back followed by zero distance changes.
-                    delta_e = delta_e % self.detection_distance
-
-                current_remaining = remaining_distance - delta_e
-
-                self._logger.debug(
-                    "Remaining: %s - Extruded: %s = %s" % (remaining_distance,
-                                                           delta_e,
-                                                           current_remaining)
-                )
+                    delta_e = read_e
+                    if self._debug:
+                        self._logger.debug("Relative Extrusion = %s",
+                                           round(delta_e, 3))
+
+                if abs(delta_e) > engine.window:
+                    # The E position jumped (e.g. a reset the hook did not
+                    # see), this is not filament going through the sensor
+                    self._logger.info("Ignoring an E jump of %.1f mm"
+                                      % delta_e)
+                    delta_e = 0.0
+
+                engine.commanded(delta_e)
+                current_remaining = engine.remaining
+
+                if self._debug:
+                    self._logger.debug("Remaining: %s - Extruded: %s = %s",
+                                       remaining_distance, delta_e,
+                                       current_remaining)
                 self._data.remaining_distance = current_remaining
+                record = self._telemetry.record
+                record(telemetry.E_POSITION, sensor.tool, read_e)
+                record(telemetry.REMAINING, sensor.tool, current_remaining)
+                record(telemetry.EXTRUDED, sensor.tool, engine.total)
 
             else:
                 # Only pause the print if it's been over 5 seconds since the last movement.
-                # Stops pausing when the CPU gets hung up.
-                timedelta = datetime.now() - self.last_movement_time
-                if timedelta.total_seconds() > 10:
-                    self.raise_emergency_response(None)
+                # Stops pausing when the CPU gets hung up. When other
+                # engines must agree, they already guard against that.
+                idle = self._clock.monotonic() - self.last_movement_time
+                if idle > 10 or self._fusion.required > 1:
+                    self._fusion.jammed(telemetry.DISTANCE)
                 else:
+                    if not self._pause_ignored:
+                        self._telemetry.record(telemetry.PAUSE_IGNORED,
+                                               telemetry.DISTANCE, idle)
+                        self._pause_ignored = True
                     self._logger.debug(
                         "Ignored pause command due to 5 second rule")
 
+    def record_edges(self):
+        """Copy the new sensor edges to the telemetry ring (scheduler)."""
+        for sensor in self._sensors.values():
+            edges = sensor.telemetry_edges.read()
+            if edges:
+                self._telemetry.record_edges(sensor.tool, edges)
+        self._telemetry_poll.arm(self.TELEMETRY_INTERVAL)
+
+    def check_health(self):
+        """Feed the new sensor edges to their health monitor (scheduler)."""
+        warnings = {}
+        for sensor in self._sensors.values():
+            reader = sensor.health_edges
+            dropped = reader.dropped
+            edges = reader.read()
+            if reader.dropped != dropped:
+                sensor.health.resync(self._gpio.input(sensor.pin))
+            else:
+                sensor.health.add(edges)
+            # Only known with the distance or flow rate accounting
+            sensor.health.commanded(
+                sensor.distance.total if self._cfg.distance_detection
+                else sensor.flow.commanded, bool(edges))
+            found = sensor.health.warnings(sensor.edges)
+            if found:
+                warnings["T%i" % sensor.tool] = found
+        if warnings != self._health_warnings:
+            for tool, found in warnings.items():
+                if found != self._health_warnings.get(tool):
+                    self._logger.warning("Sensor of %s: %s"
+                                         % (tool, "; ".join(found)))
+            self._pipeline.submit(setattr, self, "_health_warnings", warnings)
+            self.send_ui_message(dict(health=warnings))
+        self._health_poll.arm(self.HEALTH_INTERVAL)
+
+    def hook_mode_changed(self, degraded, average):
+        """Switch the G-code hook to the cheaper mode or back (HookBudget)."""
+        if degraded:
+            self._logger.warn("G-code hook takes %.1f us/line, over the budget"
+                              " of %.1f us: batching extrusion, UI updates "
+                              "suspended" % (average * 1e6,
+                                             self._cfg.hook_budget * 1e6))
+            self._debug = False
+            self._publisher.suspend()
+        else:
+            self._logger.info("G-code hook back to %.1f us/line, normal mode"
+                              % (average * 1e6))
+            self.flush_batch()
+            self._debug = self._log_debug
+            self._publisher.resume()
+            if self._publisher.clients > 0:
+                self.update_ui()
+        self.send_ui_message(dict(hook_degraded=degraded))
+
+    def status_snapshot(self):
+        """State served by the status API (pipeline)."""
+        data = self._data
+        last_motion = data.last_motion_detected
+        return StatusSnapshot(
+            self._detecting, self.response_sent, data.filament_moving,
+            data.active_tool,
+            round(data.remaining_distance)
+            if self._cfg.distance_detection else None,
+            int(last_motion) if last_motion else None,
+            data.connection_test_running, self._health_warnings)
+
     def update_ui(self):
-        self._plugin_manager.send_plugin_message(self._identifier,
-                                                 self._data.to_json())
+        """Send the full detection state to the connected clients."""
+        self._publisher.publish_all(self._data.to_dict())
+
+    def send_ui_message(self, message):
+        start = perf_counter()
+        size = len(json.dumps(message, separators=(",", ":")))
+        self._m_ui_json.observe(perf_counter() - start)
+        self._m_ui_messages.inc()
+        self._m_ui_bytes.inc(size)
+        self._plugin_manager.send_plugin_message(self._identifier, message)
+
+    def _local_path(self, payload):
+        """Path on disk of the file of an event, None if not local."""
+        origin = payload.get("origin", payload.get("storage"))
+        if origin != "local" or not payload.get("path"):
+            return None
+        return self._file_manager.path_on_disk(origin, payload["path"])
+
+    def index_file(self, payload):
+        """Index a G-code file in the background (selected or added)."""
+        if not self._cfg.gcode_index:
+            return
+        if "type" in payload and "gcode" not in payload["type"]:
+            return
+        path = self._local_path(payload)
+        if path is not None:
+            self._indexer.request(path)
+
+    def forget_file(self, payload):
+        """Drop the index of a G-code file added again or removed."""
+        path = self._local_path(payload)
+        if path is not None:
+            self._indexer.forget(path)
+
+    def planned_quiet_time(self, idle):
+        """Time left in the expected standstill of the filament at the job
+        position, or 0.
+
+        Besides the quiet windows of the index, the last ``idle`` seconds
+        of the job are quiet until they are expected to extrude the
+        filament of one sensor pulse, e.g. slow moves with little filament.
+        """
+        if self._job_path is None:
+            return 0
+        index = self._indexer.get(self._job_path)
+        if index is None:
+            return 0
+        filepos = self._printer.get_current_data()["progress"]["filepos"]
+        if filepos is None:
+            return 0
+        quiet = index.quiet_time(filepos)
+        if quiet:
+            return quiet
+        start = index.offset_before(filepos, idle)
+        extruded = index.expected_extrusion(start, filepos)
+        if extruded < self._cfg.mm_per_pulse:
+            return index.time_to_extrude(filepos,
+                                         self._cfg.mm_per_pulse - extruded)
+        return 0
+
+    def _queued(self, method):
+        """Callback of another thread applying ``method`` on the pipeline."""
+        def callback(*args):
+            self._pipeline.submit(method, *args)
+        return callback
 
     def connection_test_callback(self, is_moving=False):
         self._data.filament_moving = is_moving
 
+    def start_calibration(self, tool, length, feedrate):
+        """Extrude ``length`` mm and count the edges of the tool sensor."""
+        sensor = self._sensors.get(tool)
+        if sensor is None:
+            self._logger.warn("Calibration: tool T%i has no sensor" % tool)
+            self.send_ui_message(dict(calibration=dict(
+                tool=tool, length=length, pulses=0)))
+            return
+        if self._calibration is not None:
+            self._calibration.cancel()
+        self._calibration = Calibration(
+            tool, sensor.edges, length, self._scheduler,
+            self._queued(self.calibration_done), self.CALIBRATION_TIMEOUT)
+        self._calibration.start(length / feedrate * 60)
+        self._logger.info("Calibration: extruding %g mm with tool T%i"
+                          % (length, tool))
+        commands = ["M83", "G1 E%g F%g" % (length, feedrate)]
+        if len(self._sensors) > 1:
+            commands.insert(0, "T%i" % tool)
+        self._printer.commands(commands)
+
+    def calibration_done(self, pulses):
+        """Save the measured mm_per_pulse (Calibration callback)."""
+        calibration, self._calibration = self._calibration, None
+        if calibration is None:
+            return
+        result = dict(tool=calibration.tool, length=calibration.length,
+                      pulses=pulses)
+        if not pulses:
+            self._logger.warn("Calibration: no edge of the T%i sensor while "
+                              "extruding %g mm" % (calibration.tool,
+                                                   calibration.length))
+            self.send_ui_message(dict(calibration=result))
+            return
+        mm_per_pulse = round(calibration.mm_per_pulse, 4)
+        self._logger.info("Calibration: %i edges of the T%i sensor for %g mm,"
+                          " %s mm per pulse" % (pulses, calibration.tool,
+                                                calibration.length,
+                                                mm_per_pulse))
+        self._settings.set(["mm_per_pulse"], mm_per_pulse)
+        self._settings.set(["pulse_counting"], True)
+        self._settings.save()
+        self._apply_settings()
+        result["mm_per_pulse"] = mm_per_pulse
+        self.send_ui_message(dict(calibration=result))
+
+    def flow_slip_callback(self, ratio):
+        self._logger.warn("Measured filament is %.0f%% of the commanded one"
+                          % (ratio * 100))
+        self._fusion.jammed(telemetry.FLOW)
+
+    def flow_recovered(self):
+        self._fusion.cleared(telemetry.FLOW)
+
+    def timeout_detection_callback(self, is_moving=False):
+        if is_moving:
+            self._fusion.cleared(telemetry.TIMEOUT)
+            self._responses.cancel()
+            self._telemetry.record(telemetry.RESUME, telemetry.TIMEOUT, 0)
+            self._data.filament_moving = True
+        else:
+            self._fusion.jammed(telemetry.TIMEOUT)
+
     def print_paused(self, event=""):
-        """Remove motion sensor thread if the print is paused"""
+        """Stop the motion sensor detector if the print is paused"""
         self.print_started = False
         self._logger.info("%s: Pausing filament sensors." % event)
-        if self.sensor_enabled and self.detection_method == 0:
-            self.sensor_stop_thread()
+        self._flow_active = False
+        self._detecting = False
+        if self.sensor_enabled and self._cfg.timeout_detection:
+            self.sensor_stop_detector()
 
     # Events
-    # noinspection PyUnusedLocal
     def on_event(self, event, payload):
+        """Events change the detection state, they go to the pipeline."""
+        self._pipeline.submit(self._handle_event, event, payload)
+
+    # noinspection PyUnusedLocal
+    def _handle_event(self, event, payload):
         if event is Events.PRINT_STARTED:
             self.stop_connection_test()
             self.print_started = True
-            if self.detection_method == 1:
+            self._job_path = (self._local_path(payload)
+                              if self._cfg.gcode_index else None)
+            if self._job_path is not None:
+                self._indexer.request(self._job_path)
+            self.select_tool(0)
+            self._batch_e, self._batch_lines = 0.0, 0
+            self._budget.reset()
+            self._telemetry.sync_clock()
+            self._telemetry.reset_step()
+            self._telemetry.record(telemetry.JOB_START, 0, 0)
+            for sensor in self._sensors.values():
+                sensor.telemetry_edges.skip()
+            self._telemetry_poll.arm(self.TELEMETRY_INTERVAL)
+            if self._cfg.distance_detection:
                 self.init_distance_detection()
 
         elif event is Events.PRINT_RESUMED:
@@ -351,7 +1111,7 @@ class BovineFilamentSensorPlugin(StartupPlugin, EventHandlerPlugin,
 
             # If distance detection is used reset the remaining distance,
             # otherwise the print is not resuming anymore
-            if self.detection_method == 1:
+            if self._cfg.distance_detection:
                 self.reset_remaining_distance()
 
             self.sensor_start()
@@ -376,21 +1136,58 @@ class BovineFilamentSensorPlugin(StartupPlugin, EventHandlerPlugin,
                        Events.ERROR
                        ):
             self._logger.info("%s: Disabling filament sensors." % event)
+            for sensor in self._sensors.values():
+                if sensor.edges.dropped:
+                    self._logger.warn("%i edges of the T%i sensor were dropped"
+                                      % (sensor.edges.dropped, sensor.tool))
+                if sensor.edges.rejected:
+                    self._logger.info("%i bounces of the T%i sensor were "
+                                      "rejected" % (sensor.edges.rejected,
+                                                    sensor.tool))
             self.print_started = False
-            if self.sensor_enabled and self.detection_method == 0:
-                self.sensor_stop_thread()
+            self._flow_active = False
+            self._detecting = False
+            self._job_path = None
+            if self.sensor_enabled and self._cfg.timeout_detection:
+                self.sensor_stop_detector()
+            self.record_edges()
+            self._telemetry_poll.cancel()
 
         # Disable motion sensor if paused
         elif event is Events.PRINT_PAUSED:
             self.print_paused(event)
 
+        # Index G-code files ahead of the print
+        elif event in (Events.FILE_SELECTED, Events.FILE_ADDED):
+            if event is Events.FILE_ADDED:
+                self.forget_file(payload)
+            self.index_file(payload)
+
+        elif event is Events.FILE_REMOVED:
+            self.forget_file(payload)
+
+        elif event is Events.UPDATED_FILES:
+            self._indexer.forget()
+
         elif event is Events.USER_LOGGED_IN:
             self.update_ui()
 
+        # UI messages are only built while someone is listening
+        elif event is Events.CLIENT_OPENED:
+            self._publisher.client_opened()
+            # The changes made while nobody listened were not sent, and a
+            # reconnecting session gets no USER_LOGGED_IN
+            self.update_ui()
+
+        elif event is Events.CLIENT_CLOSED:
+            self._publisher.client_closed()
+
     # API commands
     def get_api_commands(self):
         return dict(startConnectionTest=[],
-                    stopConnectionTest=[]
+                    stopConnectionTest=[],
+                    calibrate=[],
+                    getTelemetry=[]
                     )
 
     # noinspection PyUnusedLocal
@@ -398,61 +1195,228 @@ class BovineFilamentSensorPlugin(StartupPlugin, EventHandlerPlugin,
         """"""
         self._logger.info("API: " + command)
         if command == "startConnectionTest":
-            self.start_connection_test()
+            self._pipeline.submit(self.start_connection_test)
             return flask.make_response("Started connection test", 204)
         elif command == "stopConnectionTest":
-            self.stop_connection_test()
+            self._pipeline.submit(self.stop_connection_test)
             return flask.make_response("Stopped connection test", 204)
+        elif command == "calibrate":
+            if self._printer.is_printing() or self._printer.is_paused():
+                return flask.make_response("Printer is busy", 409)
+            try:
+                tool = int(data.get("tool", 0))
+                length = float(data.get(
+                    "length", self._settings.get(["calibration_length"])))
+                feedrate = float(data.get(
+                    "feedrate", self._settings.get(["calibration_feedrate"])))
+            except (TypeError, ValueError, OverflowError):
+                return flask.make_response("Invalid tool, length or feedrate",
+                                           400)
+            # Also false for NaN
+            if tool < 0 or not (0 < length < math.inf and
+                                0 < feedrate < math.inf):
+                return flask.make_response("Invalid tool, length or feedrate",
+                                           400)
+            temperature = self._printer.get_current_temperatures().get(
+                "tool%i" % tool, {}).get("actual") or 0
+            if temperature < self.CALIBRATION_MIN_TEMP:
+                return flask.make_response("Heat the nozzle first", 409)
+            self._pipeline.submit(self.start_calibration, tool, length,
+                                  feedrate)
+            return flask.make_response("Started calibration", 204)
+        elif command == "getTelemetry":
+            # Wall times (epoch seconds), default the last 5 minutes
+            try:
+                end = float(data.get("end", self._clock.time()))
+                start = float(data.get("start", end - 300))
+            except (TypeError, ValueError):
+                return flask.make_response("Invalid start or end", 400)
+            if not 0 <= start <= end < math.inf:
+                return flask.make_response("Invalid start or end", 400)
+            response = flask.make_response(self._telemetry.entries(start,
+                                                                   end))
+            response.headers["Content-Type"] = "application/octet-stream"
+            response.headers["X-Entry-Format"] = telemetry.ENTRY.format
+            return response
         else:
             return flask.make_response("Not found", 404)
 
+    def on_api_get(self, request):
+        """Status of the detection, metrics in the Prometheus text format
+        (``?metrics``), or the health of the sensors (``?health``).
+
+        The status is the JSON of the last snapshot published by the
+        pipeline, with its version as ETag: a request whose
+        ``If-None-Match`` matches gets a 304. ``?since=<version>`` waits up
+        to ``LONG_POLL`` seconds (or ``?timeout``) for another version.
+        """
+        if "metrics" in request.args:
+            return flask.Response(self._metrics.render(),
+                                  mimetype="text/plain; version=0.0.4")
+        if "health" in request.args:
+            return flask.jsonify({
+                "T%i" % sensor.tool: dict(
+                    sensor.health.to_dict(), pin=sensor.pin,
+                    warnings=self._health_warnings.get(
+                        "T%i" % sensor.tool, []))
+                for sensor in self._sensors.values()})
+        version, etag, body = self._pipeline.status()
+        if "since" in request.args:
+            try:
+                since = int(request.args["since"])
+                timeout = float(request.args.get("timeout", self.LONG_POLL))
+            except ValueError:
+                return flask.make_response("Invalid since or timeout", 400)
+            if not math.isfinite(timeout):
+                return flask.make_response("Invalid since or timeout", 400)
+            if since == version:
+                self._pipeline.wait(version,
+                                    max(min(timeout, self.LONG_POLL), 0.0))
+                version, etag, body = self._pipeline.status()
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        # Weak comparison, as If-None-Match asks for
+        tags = [tag.strip() for tag
+                in request.headers.get("If-None-Match", "").split(",")]
+        if "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag
+                                   for tag in tags):
+            return flask.make_response("", 304, headers)
+        return flask.Response(body, mimetype="application/json",
+                              headers=headers)
+
     # noinspection PyUnusedLocal
     def distance_detection(self, comm_instance, phase, cmd, cmd_type, gcode,
                            *args, **kwargs):
         """Hook to interpret GCode commands sent to the printer.
 
+        It runs on the printer communication thread, so the lines changing
+        the detection state are only queued to the state pipeline. The time
+        spent here, which delays the sending of the line, is what the hook
+        budget watches.
+        """
+        # Only for distance and flow rate detection, or several sensors
+        if not self._cfg.gcode_hook:
+            return cmd
+        calls = self._hook_calls = self._hook_calls + 1
+        if calls & (self.HOOK_SAMPLE - 1):
+            self._queue_line(cmd, gcode)
+            return cmd
+        start = perf_counter()
+        self._queue_line(cmd, gcode)
+        elapsed = perf_counter() - start
+        self._m_hook.observe(elapsed)
+        self._budget.sample(elapsed)
+        # Sampled logging in the degraded mode
+        if (self._budget.degraded and self._log_debug and
+                not calls & (self.HOOK_SAMPLE * self.LOG_SAMPLE - 1)):
+            self._logger.debug("Sampled line '%s' (%.1f us/line on average)",
+                               cmd, self._budget.average * 1e6)
+        return cmd
+
+    def _queue_line(self, cmd, gcode):
+        """Queue a line changing the detection state to the pipeline."""
+        if gcode in MOVE_COMMANDS:
+            # Travel moves (no E word) change nothing, they are rejected
+            # here rather than queued
+            if "E" in cmd:
+                self._pipeline.submit(self._interpret, cmd, gcode)
+        elif gcode in STATE_COMMANDS or (gcode and gcode[0] == "T"):
+            self._pipeline.submit(self._interpret, cmd, gcode)
+
+    def _batch(self, extruder):
+        """Accumulate the E of a move (degraded mode)."""
+        if self._data.absolute_extrusion:
+            self._batch_e = extruder
+        else:
+            self._batch_e += extruder
+        self._batch_lines += 1
+        if self._batch_lines >= self.BATCH_LINES:
+            self.flush_batch()
+
+    def flush_batch(self):
+        """Account the E accumulated by ``_batch`` as a single move."""
+        if not self._batch_lines:
+            return
+        extruder = self._batch_e
+        self._batch_e = 0.0
+        self._batch_lines = 0
+        if self._sensor is None:
+            return
+        self._extruded(extruder)
+
+    def _extruded(self, extruder):
+        """Feed the E word of a move to the flow and distance detection."""
+        sensor = self._sensor
+        if self._flow_active:
+            sensor.flow.extruded(extruder, self._data.absolute_extrusion)
+            if not self._cfg.distance_detection:
+                # The distance detection records its own total
+                self._telemetry.record(telemetry.EXTRUDED, sensor.tool,
+                                       sensor.flow.commanded)
+        if self._cfg.distance_detection:
+            self.calc_distance(extruder)
+
+    def _interpret(self, cmd, gcode):
+        """Interpret a GCode command sent to the printer.
+
         | G92:
         |  - Resets the distance detection values.
         |  - Signals sensor start monitoring.
         | G0-G3:
         |  - Calculate the remaining distance.
+        |  - Account commanded extrusion for flow rate detection.
+        | T<n>:
+        |  - Switch to the sensor of the new tool.
         """
-        # Only for distance detection
-        if self.detection_method == 1 and self.sensor_enabled:
-            # G0/G1 for linear moves, G2/G3 for circle movements
-            if gcode in ["G0", "G1", "G2", "G3"]:
-                commands = cmd.split(" ")
-
-                for command in commands:
-                    if command.startswith("E"):
-                        extruder = command[1:]
-                        self._logger.debug("----- RUNNING calc_distance -----")
-                        self._logger.debug(
-                            "Found extrude command in '%s' with value: %s") % (cmd, extruder)
-                        self.calc_distance(float(extruder))
-
-            # G92 reset extruder
-            elif gcode == "G92":
-                if self.detection_method == 1:
-                    self.init_distance_detection()
-                self._logger.debug(
-                    "Found G92 command in '%s' : Reset Extruders" % cmd)
-
-            # M82 absolute extrusion mode
-            elif gcode == "M82":
-                self._data.absolute_extrusion = True
-                self._logger.info(
-                    "Found M82 command in '%s' : Absolute extrusion") % cmd
-                self.last_e = 0
+        cfg = self._cfg
+
+        # G0/G1 for linear moves, G2/G3 for circle movements
+        if gcode in MOVE_COMMANDS:
+            extruder = extract_e(cmd)
+            if extruder is not None and self._sensor is not None:
+                if self._budget.degraded:
+                    self._batch(extruder)
+                    return
+                if self._debug:
+                    self._logger.debug(
+                        "Found extrude command in '%s' with value: %s", cmd, extruder)
+                self._extruded(extruder)
+            return
 
-            # M83 relative extrusion mode
-            elif gcode == "M83":
-                self._data.absolute_extrusion = False
-                self._logger.info(
-                    "Found M83 command in '%s' : Relative extrusion") % cmd
-                self.last_e = 0
+        if self._batch_lines:
+            # Moves batched so far belong to the previous extrusion state
+            self.flush_batch()
 
-        return cmd    
+        # G92 reset extruder
+        if gcode == "G92":
+            if cfg.distance_detection:
+                self.init_distance_detection()
+            if self._sensor is not None:
+                self._sensor.flow.reset_position()
+            if self._debug:
+                self._logger.debug(
+                    "Found G92 command in '%s' : Reset Extruders", cmd)
+
+        # M82 absolute extrusion mode
+        elif gcode == "M82":
+            self._data.absolute_extrusion = True
+            self._logger.info(
+                "Found M82 command in '%s' : Absolute extrusion", cmd)
+            self.last_e = 0
+
+        # M83 relative extrusion mode
+        elif gcode == "M83":
+            self._data.absolute_extrusion = False
+            self._logger.info(
+                "Found M83 command in '%s' : Relative extrusion", cmd)
+            self.last_e = 0
+
+        # Tool change
+        elif gcode and gcode[0] == "T":
+            try:
+                tool = int(cmd.split(" ", 1)[0][1:])
+            except ValueError:
+                return
+            self.select_tool(tool)
 
     def get_update_information(self):
         """Software Update Hook.
@@ -495,9 +1459,4 @@ def __plugin_load__():
 
 
 def __plugin_check__():
-    try:
-        import RPi.GPIO
-    except ImportError:
-        return False
-
-    return True
+    return bool(available_backends())
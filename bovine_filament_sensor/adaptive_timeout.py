@@ -0,0 +1,43 @@
+class AdaptiveTimeout:
+    """Idle timeout following the extrusion rate of the print.
+
+    The commanded filament is read from the FlowRateMonitor of the sensor,
+    which accounts the E words sent to the printer. The timeout expires
+    once the filament commanded since the last sensor edge should have
+    turned the wheel ``pulses`` times, which takes less time the faster
+    the print goes, but never before ``floor`` seconds. The static
+    max_idle_time of the TimeoutDetector remains the ceiling, e.g. while
+    nothing is extruded.
+    """
+
+    def __init__(self, flow, pulses, floor):
+        self._flow = flow
+        self.pulses = pulses
+        self.floor = floor
+        self._mark = flow.commanded
+
+    def motion(self):
+        """The sensor moved: start counting the commanded filament again."""
+        self._mark = self._flow.commanded
+
+    def missing_pulses(self):
+        """Sensor pulses expected since the last edge."""
+        commanded = self._flow.commanded - self._mark
+        if commanded < 0:
+            # The monitor was reset
+            self._mark = self._flow.commanded
+            return 0.0
+        return commanded / self._flow.mm_per_pulse
+
+    def due(self, idle):
+        """Idle time at which the timeout expires, ``idle`` seconds after the
+        last edge, if the filament keeps being commanded at the same rate.
+        Expired when not over ``idle``.
+        """
+        missing = self.missing_pulses()
+        if missing >= self.pulses:
+            return self.floor
+        if missing <= 0:
+            # Nothing commanded yet, look again a floor later
+            return idle + self.floor
+        return max(idle * self.pulses / missing, self.floor)
@@ -0,0 +1,49 @@
+class Calibration:
+    """Measure the filament length per sensor edge.
+
+    The plugin extrudes ``length`` mm and the edges of the sensor are
+    counted until the wheel has stood still for ``SETTLE`` seconds after
+    the expected end of the extrusion. ``callback(pulses)`` is then called
+    on the scheduler thread, with 0 when no edge came within ``timeout``
+    seconds.
+    """
+
+    SETTLE = 1.0
+
+    def __init__(self, tool, edges, length, scheduler, callback, timeout):
+        self.tool = tool
+        self.length = length
+        self.callback = callback
+        self.timeout = timeout
+        self.pulses = 0
+        self._edges = edges.reader()
+        self._deadline = scheduler.deadline(self.check)
+        self._clock = scheduler.clock
+        self._until = None
+
+    def start(self, duration):
+        """Count the edges of an extrusion lasting about ``duration`` s."""
+        self.pulses = 0
+        self._edges.skip()
+        self._until = self._clock.monotonic() + duration + self.timeout
+        self._deadline.arm(duration + self.SETTLE)
+
+    def cancel(self):
+        self._deadline.cancel()
+
+    def check(self):
+        edges = self._edges.read()
+        self.pulses += len(edges)
+        now = self._clock.monotonic()
+        if edges and now - edges[-1] < self.SETTLE and now < self._until:
+            self._deadline.arm(self.SETTLE)
+            return
+        if not self.pulses and now < self._until:
+            # Slow printer, the extrusion did not start yet
+            self._deadline.arm(self.SETTLE)
+            return
+        self.callback(self.pulses)
+
+    @property
+    def mm_per_pulse(self):
+        return self.length / self.pulses if self.pulses else None
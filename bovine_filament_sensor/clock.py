@@ -0,0 +1,72 @@
+"""Time source of the plugin.
+
+Every component reads the time from a clock. ``MONOTONIC`` is the
+production clock, which NTP corrections on a freshly booted Pi do not
+move. A ``VirtualClock`` only advances when told to: the scheduler and
+the state pipeline attached to it then run on the caller thread at the
+exact virtual time their work is due, so a 10-hour print can be replayed
+in seconds and detection latencies compared exactly.
+"""
+import time
+
+
+class MonotonicClock:
+    virtual = False
+
+    @staticmethod
+    def monotonic():
+        return time.monotonic()
+
+    @staticmethod
+    def time():
+        """Wall time (epoch seconds), only for display and telemetry."""
+        return time.time()
+
+
+MONOTONIC = MonotonicClock()
+
+
+class VirtualClock:
+    """Clock moved forward by ``advance``.
+
+    Attached drivers (DeadlineScheduler, StatePipeline) have a
+    ``next_due()`` method returning the virtual time of their next piece
+    of work, or None, and ``run_due()`` doing the work due now.
+    """
+
+    virtual = True
+
+    def __init__(self, start=0.0, epoch=None):
+        self._now = start
+        # Wall time at monotonic time 0
+        self._epoch = time.time() - start if epoch is None else epoch
+        self._drivers = []
+
+    def monotonic(self):
+        return self._now
+
+    def time(self):
+        return self._epoch + self._now
+
+    def attach(self, driver):
+        self._drivers.append(driver)
+
+    def advance(self, seconds):
+        """Move ``seconds`` forward, running the work due meanwhile."""
+        self.advance_to(self._now + seconds)
+
+    def advance_to(self, when):
+        while True:
+            due = [d for d in (driver.next_due() for driver in self._drivers)
+                   if d is not None]
+            if not due:
+                break
+            first = min(due)
+            if first > when:
+                break
+            if first > self._now:
+                self._now = first
+            for driver in self._drivers:
+                driver.run_due()
+        if when > self._now:
+            self._now = when
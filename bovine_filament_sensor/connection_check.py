@@ -1,54 +1,240 @@
 #!/usr/bin/python3
+"""Filament sensor bench and diagnostics.
 
-# ----------------------------- #
-#          Instructions         #
-# ----------------------------- #
-#
-#  - Run this script on the OctoPi
-#  - > python3 connection_check.py
-#  - To save some filament you can unload the
-#    filament before and move it manually in the sensor
+Watches the sensor with the GPIO backends and the timeout detector of the
+plugin and prints, every ``--interval`` seconds, the edge rate, the
+filament speed, the duty cycle and the period jitter. Interval and pulse
+width histograms are printed on exit (Ctrl-C or ``--duration``).
+``--capture`` writes the edge times to a file that
+``extras/benchmarks/replay.py --edges`` replays.
 
+Run it on the OctoPi and move some filament through the sensor by hand:
 
-import RPi.GPIO as GPIO
+    $ python3 connection_check.py --pin 24 --mode bcm --backend rpi
+    $ python3 connection_check.py --backend gpiod --capture sensor.txt
+
+DO NOT run it during a print, it uses the same GPIO pin as the plugin.
+"""
+import argparse
+import logging
+import math
+import random
+import sys
+import threading
 import time
+from types import SimpleNamespace
 
-# GPIO pin configuration
-PIN = 24
-GPIO.setmode(GPIO.BCM)    # GPIO.BCM/GPIO.BOARD
-GPIO.setup(PIN, GPIO.IN)
+if __package__:
+    from .edge_buffer import EdgeBuffer
+    from .gpio_backend import BOARD, BCM, BACKENDS, create_backend
+    from .metrics import Histogram
+    from .scheduler import DeadlineScheduler
+    from .timeout_detection import TimeoutDetector
+else:
+    # Run as a script: these modules do not need OctoPrint, so load them
+    # without running the package __init__
+    import os
+    import types
+    package = types.ModuleType("bovine_filament_sensor")
+    package.__path__ = [os.path.dirname(os.path.abspath(__file__))]
+    sys.modules.setdefault("bovine_filament_sensor", package)
+    from bovine_filament_sensor.edge_buffer import EdgeBuffer
+    from bovine_filament_sensor.gpio_backend import (BOARD, BCM, BACKENDS,
+                                                     create_backend)
+    from bovine_filament_sensor.metrics import Histogram
+    from bovine_filament_sensor.scheduler import DeadlineScheduler
+    from bovine_filament_sensor.timeout_detection import TimeoutDetector
 
-# Time in seconds
-max_idle_time = 2
+# Histogram bounds (seconds), 1-2-5 steps from 0.1 ms to 5 s
+BOUNDS = tuple(m * 10.0 ** e for e in range(-4, 1) for m in (1, 2, 5))
 
-lastValue = GPIO.input(PIN)
-# Get current time in seconds
-lastMotion = time.time()
 
+class EdgeStats:
+    """Statistics of the edges of one sensor.
 
-def main():
-    try:
-        GPIO.add_event_detect(PIN, GPIO.BOTH, callback=motion)
+    Edges alternate between rising and falling, so with the level before
+    the first edge the intervals split into high and low pulse widths.
+    """
+
+    def __init__(self, level):
+        self.level = level      # level after the last edge
+        self.last = None
+        self.intervals = Histogram("interval", "", BOUNDS)
+        self.high = Histogram("high", "", BOUNDS)
+        self.low = Histogram("low", "", BOUNDS)
+        self._previous = None   # interval before the last one
+        self._periods = []      # rising to rising, falling to falling
+
+    def add(self, times):
+        for t in times:
+            if self.last is not None:
+                interval = t - self.last
+                self.intervals.observe(interval)
+                # The interval that ends here had the level of the last edge
+                (self.high if self.level else self.low).observe(interval)
+                if self._previous is not None:
+                    self._periods.append(self._previous + interval)
+                self._previous = interval
+            self.last = t
+            self.level = not self.level
+
+    def take_periods(self):
+        periods, self._periods = self._periods, []
+        return periods
+
+    def duty_cycle(self):
+        high, low = self.high.sum, self.low.sum
+        return high / (high + low) if high + low else None
+
+
+def mean_stdev(values):
+    n = len(values)
+    if n == 0:
+        return None, None
+    mean = sum(values) / n
+    if n == 1:
+        return mean, 0.0
+    return mean, math.sqrt(sum((v - mean) ** 2 for v in values) / (n - 1))
+
+
+def print_histogram(title, histogram, width=40):
+    total = histogram.counts and sum(histogram.counts)
+    print("\n%s (%d)" % (title, total))
+    if not total:
+        return
+    peak = max(histogram.counts)
+    labels = ["< %s" % format_time(b) for b in histogram.bounds] + [
+        ">= %s" % format_time(histogram.bounds[-1])]
+    first = next(n for n, c in enumerate(histogram.counts) if c)
+    last = max(n for n, c in enumerate(histogram.counts) if c)
+    for n in range(first, last + 1):
+        count = histogram.counts[n]
+        print("  %9s %7d %s" % (labels[n], count,
+                                "#" * int(round(count * width / peak))))
 
-        while True:
-            timespan = (time.time() - lastMotion)
 
-            if timespan > max_idle_time:
-                print("IDLE")
-            else:
-                print("MOVING")
+def format_time(seconds):
+    if seconds < 1e-3:
+        return "%.0f us" % (seconds * 1e6)
+    if seconds < 1:
+        return "%.3g ms" % (seconds * 1e3)
+    return "%.3g s" % seconds
 
-            time.sleep(0.250)
 
+def simulate(backend, pin, rate, stop):
+    """Emit edges at ``rate`` Hz with some jitter (mock backend)."""
+    rnd = random.Random(0)
+    while not stop.wait(max(rnd.gauss(1.0 / rate, 0.05 / rate), 0)):
+        backend.levels[pin] = not backend.levels.get(pin, False)
+        backend.emit(pin)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n")[0],
+        epilog="Move some filament through the sensor by hand.")
+    parser.add_argument("--pin", type=int, default=24,
+                        help="sensor pin (default 24)")
+    parser.add_argument("--mode", choices=("bcm", "board"), default="bcm",
+                        help="pin numbering (default bcm)")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="rpi",
+                        help="GPIO backend (default rpi)")
+    parser.add_argument("--chip", default="/dev/gpiochip0",
+                        help="GPIO character device of the gpiod backend")
+    parser.add_argument("--debounce", type=float, default=0.0,
+                        help="debounce time in ms (default 0)")
+    parser.add_argument("--idle", type=float, default=2.0,
+                        help="seconds without edges before IDLE (default 2)")
+    parser.add_argument("--mm-per-pulse", type=float, default=1.0,
+                        help="filament per edge for the speed (default 1)")
+    parser.add_argument("--interval", type=float, default=1.0,
+                        help="seconds between two reports (default 1)")
+    parser.add_argument("--duration", type=float,
+                        help="stop after this many seconds")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="write the edge times to FILE (replay format)")
+    parser.add_argument("--simulate", type=float, metavar="HZ",
+                        help="mock backend: emit edges at HZ")
+    args = parser.parse_args(argv)
+    if args.simulate and args.backend != "mock":
+        parser.error("--simulate drives the mock backend, use --backend mock "
+                     "(the %s backend reads a real sensor)" % args.backend)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger("connection_check")
+    backend = create_backend(args.backend, logger, chip=args.chip)
+    backend.set_mode(BOARD if args.mode == "board" else BCM)
+    edges = EdgeBuffer()
+    backend.add_edge_detection(args.pin, edges, args.debounce / 1000.0)
+    reader = edges.reader()
+    stats = EdgeStats(backend.input(args.pin))
+
+    scheduler = DeadlineScheduler(logger)
+    scheduler.start()
+    detector = TimeoutDetector(
+        "ConnectionCheck", edges, args.idle, logger, SimpleNamespace(),
+        scheduler, callback=lambda moving: print(
+            "MOVING" if moving else "IDLE (no edge for %s s)" % args.idle))
+    detector.start()
+
+    stop = threading.Event()
+    if args.simulate:
+        threading.Thread(target=simulate, daemon=True,
+                         args=(backend, args.pin, args.simulate, stop)).start()
+
+    capture = None
+    if args.capture:
+        capture = open(args.capture, "w")
+        capture.write("# bovine_filament_sensor edge capture: pin %i (%s), "
+                      "backend %s, debounce %g ms, initial level %i\n"
+                      % (args.pin, args.mode, args.backend, args.debounce,
+                         stats.level))
+        capture.write("# %s\n" % time.strftime("%Y-%m-%d %H:%M:%S"))
+
+    print("Watching pin %i (%s) with the %s backend, Ctrl-C to stop"
+          % (args.pin, args.mode, args.backend))
+    start = time.monotonic()
+    try:
+        while not stop.wait(args.interval):
+            times = reader.read()
+            stats.add(times)
+            if capture is not None and times:
+                capture.writelines("%.6f\n" % t for t in times)
+            rate = len(times) / args.interval
+            period, jitter = mean_stdev(stats.take_periods())
+            duty = stats.duty_cycle()
+            print("%8.1f edges/s %7.2f mm/s  duty %5s  period %9s  "
+                  "jitter %9s  rejected %i"
+                  % (rate, rate * args.mm_per_pulse,
+                     "%.0f%%" % (duty * 100) if duty is not None else "-",
+                     format_time(period) if period else "-",
+                     format_time(jitter) if period else "-",
+                     edges.rejected))
+            if (args.duration is not None and
+                    time.monotonic() - start >= args.duration):
+                break
     except KeyboardInterrupt:
-        GPIO.remove_event_detect(PIN)
-        print("Done")
+        pass
+    finally:
+        stop.set()
+        detector.stop()
+        backend.remove_edge_detection(args.pin)
+        backend.close()
+        scheduler.stop()
+        if capture is not None:
+            capture.close()
 
-# noinspection PyUnusedLocal
-def motion(pin):
-    global lastMotion
-    lastMotion = time.time()
-    print("Motion detected at " + str(lastMotion))
+    print_histogram("Edge intervals", stats.intervals)
+    print_histogram("High pulse widths", stats.high)
+    print_histogram("Low pulse widths", stats.low)
+    if edges.dropped:
+        print("%i edges dropped" % edges.dropped)
+    print("Done")
 
 
-main()
+if __name__ == "__main__":
+    sys.exit(main())
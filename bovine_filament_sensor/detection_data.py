@@ -1,6 +1,19 @@
-import json
+from collections import namedtuple
+
+# Immutable view of the detection published by the state pipeline and
+# served by the status API. Coarse on purpose (whole mm and seconds): its
+# version only changes when a dashboard has something new to show.
+StatusSnapshot = namedtuple("StatusSnapshot", (
+    "detecting", "jammed", "filament_moving", "active_tool",
+    "remaining_distance", "last_motion_detected", "connection_test_running",
+    "health"))
+
 
 class DetectionData:
+    # Fields shown by the sidebar and settings view models
+    UI_FIELDS = ("remaining_distance", "last_motion_detected",
+                 "filament_moving", "connection_test_running", "active_tool")
+
     def __init__(self, remaining_distance, absolute_extrusion, callback=None):
         self._remaining_distance = remaining_distance
         self._absolute_extrusion = absolute_extrusion
@@ -14,6 +27,7 @@ class DetectionData:
         self._last_motion_detected = ""
         self._connection_test_running = None
         self._filament_moving = False
+        self._active_tool = 0
 
     @property
     def remaining_distance(self):
@@ -22,7 +36,7 @@ class DetectionData:
     @remaining_distance.setter
     def remaining_distance(self, value):
         self._remaining_distance = value
-        self.update_gui()
+        self.update_gui("remaining_distance", value)
 
     @property
     def print_started(self):
@@ -63,7 +77,7 @@ class DetectionData:
     @last_motion_detected.setter
     def last_motion_detected(self, value):
         self._last_motion_detected = value
-        self.update_gui()
+        self.update_gui("last_motion_detected", value)
 
     @property
     def filament_moving(self):
@@ -72,7 +86,7 @@ class DetectionData:
     @filament_moving.setter
     def filament_moving(self, value):
         self._filament_moving = value
-        self.update_gui()
+        self.update_gui("filament_moving", value)
 
     @property
     def connection_test_running(self):
@@ -81,7 +95,17 @@ class DetectionData:
     @connection_test_running.setter
     def connection_test_running(self, value):
         self._connection_test_running = value
-        self.update_gui()
+        self.update_gui("connection_test_running", value)
+
+    @property
+    def active_tool(self):
+        return self._active_tool
+
+    @active_tool.setter
+    def active_tool(self, value):
+        self._active_tool = value
+        self.update_gui("active_tool", value)
 
-    def to_json(self):
-        return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
+    def to_dict(self):
+        """Snapshot of the fields shown in the UI."""
+        return {name: getattr(self, name) for name in self.UI_FIELDS}
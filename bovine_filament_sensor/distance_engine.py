@@ -0,0 +1,87 @@
+class DistanceEngine:
+    """Distance detection crediting the filament measured by the sensor.
+
+    The commanded filament (E words of the moves sent) and the sensor
+    pulses are accounted in ``BUCKETS`` slices of commanded filament that
+    cover the last ``window`` mm. Each pulse credits ``mm_per_pulse`` mm
+    and the remaining distance is the detection distance minus the
+    filament missing over the window, so one spurious edge only gives one
+    pulse worth of filament back, and a calibration error of a few percent
+    only costs that fraction of the window.
+
+    Without ``mm_per_pulse`` (not calibrated) any edge gives the whole
+    detection distance back, as the plugin always did.
+    """
+
+    BUCKETS = 8
+
+    def __init__(self, detection_distance, mm_per_pulse=None, window=None):
+        self.detection_distance = detection_distance
+        self.mm_per_pulse = mm_per_pulse
+        # Wider than the detection distance, so that a jam fills it
+        self.window = window or 2.0 * detection_distance
+        self._width = self.window / self.BUCKETS
+        # Filament commanded since the engine was created (telemetry)
+        self.total = 0.0
+        self.reset()
+
+    def configure(self, detection_distance, mm_per_pulse=None, window=None):
+        """Change the settings, keeping the filament missing so far."""
+        deficit, allowance = self._deficit, self.allowance
+        self.detection_distance = detection_distance
+        self.mm_per_pulse = mm_per_pulse
+        self.window = window or 2.0 * detection_distance
+        self._width = self.window / self.BUCKETS
+        self.reset(allowance)
+        # It now stands in the current slice
+        self._missing[0] = self._deficit = deficit
+
+    def reset(self, allowance=0):
+        """Start again with ``allowance`` mm on top of the distance.
+
+        The allowance covers the start sequence and is dropped once the
+        sensor moves.
+        """
+        self._missing = [0.0] * self.BUCKETS   # commanded - measured
+        self._slot = 0
+        self._filled = 0.0      # commanded in the current slice
+        self._deficit = 0.0     # sum of _missing
+        self.allowance = allowance
+
+    @property
+    def remaining(self):
+        deficit = self._deficit
+        return (self.detection_distance + self.allowance -
+                (deficit if deficit > 0 else 0.0))
+
+    def measured(self, pulses):
+        """Credit ``pulses`` sensor edges."""
+        self.allowance = 0
+        if self.mm_per_pulse is None:
+            self._missing = [0.0] * self.BUCKETS
+            self._deficit = 0.0
+            return
+        credit = pulses * self.mm_per_pulse
+        self._missing[self._slot] -= credit
+        self._deficit -= credit
+
+    def commanded(self, mm):
+        """Account the filament of a move sent to the printer."""
+        self.total += mm if mm > 0 else -mm
+        if self.mm_per_pulse is not None and mm < 0:
+            # The sensor wheel turns on retractions as well
+            mm = -mm
+        self._deficit += mm
+        missing = self._missing
+        width = self._width
+        while self._filled + mm > width:
+            # Complete the current slice, the oldest one leaves the window
+            part = width - self._filled
+            missing[self._slot] += part
+            mm -= part
+            self._slot = slot = (self._slot + 1) % self.BUCKETS
+            self._deficit -= missing[slot]
+            missing[slot] = 0.0
+            self._filled = 0.0
+        missing[self._slot] += mm
+        self._filled += mm
@@ -0,0 +1,122 @@
+from array import array
+
+
+class EdgeBuffer:
+    """Preallocated ring buffer of monotonic edge timestamps.
+
+    The GPIO callback is the only writer and ``push`` only stores a float
+    and bumps a counter, so no lock is needed. Consumers read the edges in
+    batches through their own EdgeReader.
+
+    With ``set_debounce`` edges closer than the debounce time to the last
+    accepted one are rejected and counted, for the backends that cannot
+    filter bounces in the kernel.
+    """
+
+    def __init__(self, size=16384):
+        if size & (size - 1):
+            raise ValueError("EdgeBuffer size must be a power of two")
+        self.size = size
+        self._mask = size - 1
+        self._times = array("d", bytes(8 * size))
+        self.count = 0      # edges written since start
+        self.dropped = 0    # edges overwritten before a reader got them
+        self.rejected = 0   # bounces rejected by the debounce filter
+        self.debounce = 0.0
+        self._accepted = float("-inf")
+
+    def set_debounce(self, seconds):
+        """Reject the edges closer than ``seconds`` to the previous one."""
+        self.debounce = seconds
+        if seconds > 0:
+            self.push = self._push_debounced
+            self.extend = self._extend_debounced
+        else:
+            # Back to the unfiltered methods of the class
+            self.__dict__.pop("push", None)
+            self.__dict__.pop("extend", None)
+
+    def push(self, timestamp):
+        n = self.count
+        self._times[n & self._mask] = timestamp
+        self.count = n + 1
+
+    def extend(self, timestamps):
+        """Append a batch of edges, oldest first."""
+        times = self._times
+        mask = self._mask
+        n = self.count
+        for timestamp in timestamps:
+            times[n & mask] = timestamp
+            n += 1
+        self.count = n
+
+    def _push_debounced(self, timestamp):
+        if timestamp - self._accepted < self.debounce:
+            self.rejected += 1
+            return
+        self._accepted = timestamp
+        n = self.count
+        self._times[n & self._mask] = timestamp
+        self.count = n + 1
+
+    def _extend_debounced(self, timestamps):
+        times = self._times
+        mask = self._mask
+        debounce = self.debounce
+        accepted = self._accepted
+        n = self.count
+        for timestamp in timestamps:
+            if timestamp - accepted < debounce:
+                self.rejected += 1
+                continue
+            accepted = timestamp
+            times[n & mask] = timestamp
+            n += 1
+        self._accepted = accepted
+        self.count = n
+
+    def reader(self):
+        """Return a reader positioned after the edges already written."""
+        return EdgeReader(self)
+
+
+class EdgeReader:
+    """Cursor of one consumer on an EdgeBuffer."""
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self.position = buffer.count
+        self.dropped = 0
+
+    def read(self):
+        """Return the timestamps of the new edges, oldest first."""
+        buf = self._buffer
+        end = buf.count
+        start = self.position
+        if end == start:
+            return []
+        if end - start > buf.size:
+            self._drop(end - start - buf.size)
+            start = end - buf.size
+        first = start & buf._mask
+        last = end & buf._mask
+        if first < last:
+            times = buf._times[first:last].tolist()
+        else:
+            times = buf._times[first:].tolist() + buf._times[:last].tolist()
+        # The writer may have wrapped over the oldest entries while copying
+        overrun = buf.count - start - buf.size
+        if overrun > 0:
+            self._drop(overrun)
+            times = times[overrun:]
+        self.position = end
+        return times
+
+    def skip(self):
+        """Discard the pending edges."""
+        self.position = self._buffer.count
+
+    def _drop(self, n):
+        self.dropped += n
+        self._buffer.dropped += n
@@ -0,0 +1,114 @@
+from array import array
+from .clock import MONOTONIC
+
+
+class FlowRateMonitor:
+    """Compare the filament velocity seen by the sensor with the commanded one.
+
+    Commanded extrusion (from the E words of the G-code sent) and sensor
+    edges are accumulated as running totals. Their values are marked at
+    the start of each of ``BUCKETS`` time slices, so the totals over the
+    last ``window`` seconds are a subtraction. When the measured length
+    stays below ``min_ratio`` times the commanded one for ``SLIP_CHECKS``
+    consecutive slices, ``callback(ratio)`` is called, and ``recovered()``
+    once the ratio is back above ``min_ratio``.
+    """
+
+    BUCKETS = 10
+    SLIP_CHECKS = 2
+
+    def __init__(self, edges, mm_per_pulse, window, min_ratio,
+                 min_commanded=5.0, callback=None, recovered=None,
+                 clock=MONOTONIC):
+        self._edges = edges
+        self._clock = clock
+        self.mm_per_pulse = mm_per_pulse
+        self.min_ratio = min_ratio
+        self.min_commanded = min_commanded
+        self.callback = callback
+        self.recovered = recovered
+        self._width = window / self.BUCKETS
+        self._e_marks = array("d", bytes(8 * self.BUCKETS))
+        self._n_marks = array("q", bytes(8 * self.BUCKETS))
+        self.reset()
+
+    def reset(self):
+        """Start a new window, e.g. when the sensor is (re)started."""
+        self._commanded = 0.0
+        self._last_e = None
+        self._bucket = None
+        self._filled = 0
+        self._slips = 0
+        self.ratio = None
+
+    @property
+    def commanded(self):
+        """Filament commanded since the last reset (mm)."""
+        return self._commanded
+
+    def set_window(self, window):
+        """Change the window, the commanded total is kept."""
+        self._width = window / self.BUCKETS
+        # The next move starts a window of the new width
+        self._bucket = None
+        self._slips = 0
+
+    def reset_position(self):
+        """The extruder position was reset (G92)."""
+        self._last_e = None
+
+    def extruded(self, read_e, absolute):
+        """Account the E word of a move sent to the printer."""
+        if absolute:
+            last_e = self._last_e
+            self._last_e = read_e
+            if last_e is None:
+                return
+            delta_e = read_e - last_e
+        else:
+            delta_e = read_e
+        # The sensor wheel turns on retractions as well
+        self._commanded += delta_e if delta_e > 0 else -delta_e
+
+        bucket = int(self._clock.monotonic() / self._width)
+        if bucket != self._bucket:
+            self._roll(bucket)
+
+    def _roll(self, bucket):
+        """Mark the totals at the start of the new slices and check them."""
+        buckets = self.BUCKETS
+        commanded = self._commanded
+        count = self._edges.count
+        if self._bucket is None or bucket - self._bucket >= buckets:
+            # First move or long pause: restart the window
+            for n in range(buckets):
+                self._e_marks[n] = commanded
+                self._n_marks[n] = count
+            self._bucket = bucket
+            self._filled = 0
+            return
+
+        for n in range(self._bucket + 1, bucket + 1):
+            slot = n % buckets
+            start_e = self._e_marks[slot]
+            start_n = self._n_marks[slot]
+            self._e_marks[slot] = commanded
+            self._n_marks[slot] = count
+        self._filled += bucket - self._bucket
+        self._bucket = bucket
+        if self._filled >= buckets:
+            self._check(commanded - start_e, count - start_n)
+
+    def _check(self, commanded, pulses):
+        if commanded < self.min_commanded:
+            self._slips = 0
+            return
+        self.ratio = pulses * self.mm_per_pulse / commanded
+        if self.ratio >= self.min_ratio:
+            if self._slips >= self.SLIP_CHECKS and self.recovered is not None:
+                self.recovered()
+            self._slips = 0
+            return
+        self._slips += 1
+        if self._slips >= self.SLIP_CHECKS and self.callback is not None:
+            self.callback(self.ratio)
@@ -0,0 +1,49 @@
+class DetectionFusion:
+    """Decide when the verdicts of the detection engines pause the print.
+
+    The engines (timeout, distance, flow rate; their telemetry reasons)
+    run side by side on the same edges and G-code lines and report
+    ``jammed(reason)`` when they consider the filament stuck, and
+    ``cleared(reason)`` when they see it move again. ``callback(reason)``
+    is called for each jammed verdict while at least ``votes`` engines
+    agree, ``reason`` being the engine that completed the vote.
+
+    One vote pauses on the first engine (fastest), more votes wait for
+    engines with different failure modes to agree (fewer false pauses).
+    The votes needed never exceed the number of engines running.
+    """
+
+    def __init__(self, votes, callback):
+        self.votes = votes
+        self.callback = callback
+        self._jammed = {}
+
+    def set_engines(self, reasons):
+        """Engines taking part, the verdicts of the others are dropped."""
+        self._jammed = {reason: self._jammed.get(reason, False)
+                        for reason in reasons}
+
+    @property
+    def required(self):
+        return max(min(self.votes, len(self._jammed)), 1)
+
+    def agreeing(self):
+        return sum(self._jammed.values())
+
+    def jammed(self, reason):
+        if reason not in self._jammed:
+            return
+        self._jammed[reason] = True
+        if self.agreeing() >= self.required:
+            self.callback(reason)
+
+    def cleared(self, reason):
+        """Motion seen by ``reason``, True if it was jammed."""
+        if self._jammed.get(reason):
+            self._jammed[reason] = False
+            return True
+        return False
+
+    def reset(self):
+        for reason in self._jammed:
+            self._jammed[reason] = False
@@ -0,0 +1,21 @@
+# Linear (G0/G1) and circular (G2/G3) moves
+MOVE_COMMANDS = frozenset(("G0", "G1", "G2", "G3"))
+# Commands changing the detection state, besides tool changes (T<n>)
+STATE_COMMANDS = MOVE_COMMANDS | frozenset(("G92", "M82", "M83"))
+
+
+def extract_e(cmd):
+    """Return the value of the E word of a move command, or None.
+
+    The line is scanned once by ``str.find``. Lines without an E word,
+    which are most travel moves, are rejected without building any
+    intermediate list.
+    """
+    start = cmd.find("E")
+    if start < 0:
+        return None
+    end = cmd.find(" ", start)
+    try:
+        return float(cmd[start + 1:end] if end > 0 else cmd[start + 1:])
+    except ValueError:
+        return None
@@ -0,0 +1,314 @@
+"""Extrusion index of a G-code file, built once in the background.
+
+The index stores, keyed by the byte offset of a line, the cumulative
+filament length and the expected print time before the line, sampled
+every ``SAMPLE_TIME`` seconds of printing, and the windows in which the
+filament is not expected to move: dwells (G4), waits for the user or for
+heaters (M0, M600, M109, ...) and long travel sequences. Indexes are
+cached on disk keyed by the SHA-1 of the file.
+"""
+import bisect
+import hashlib
+import math
+import os
+import queue
+import re
+import threading
+from array import array
+
+WORD = re.compile(r"([A-Z])([-+]?\d*\.?\d+)")
+
+# Commands after which the printer waits an unknown time
+WAIT_COMMANDS = frozenset(("M0", "M1", "M25", "M226", "M600", "M601",
+                           "M109", "M190", "M116", "@PAUSE"))
+
+
+class GcodeIndex:
+    SAMPLE_TIME = 0.25      # seconds of printing between two samples
+    MIN_QUIET = 2.0         # shortest non-extruding window recorded
+    DEFAULT_FEEDRATE = 1500.0
+    MAGIC = b"BFSIDX02"
+
+    def __init__(self):
+        # Samples
+        self.offsets = array("q")
+        self.extrusion = array("d")     # cumulative filament (mm)
+        self.times = array("d")         # cumulative print time (s)
+        # Quiet windows
+        self.quiet_starts = array("q")
+        self.quiet_ends = array("q")
+        self.quiet_durations = array("d")   # inf for waits
+
+    @classmethod
+    def scan(cls, path):
+        """Build the index of the file at ``path``."""
+        index = cls()
+        pos = [0.0, 0.0, 0.0, 0.0]  # X Y Z E
+        absolute = True
+        absolute_e = True
+        feedrate = cls.DEFAULT_FEEDRATE
+        extrusion = 0.0
+        elapsed = 0.0
+        next_sample = 0.0
+        quiet_start = None      # offset where the filament stopped
+        quiet_time = 0.0
+        offset = 0
+
+        def close_quiet(end):
+            if quiet_start is not None and quiet_time >= cls.MIN_QUIET:
+                index.add_quiet(quiet_start, end, quiet_time)
+
+        with open(path, "rb") as f:
+            for raw in f:
+                line_offset = offset
+                offset += len(raw)
+                line = raw.split(b";", 1)[0].strip().upper()
+                if not line:
+                    continue
+                line = line.decode("ascii", "replace")
+                command = line.split(None, 1)[0]
+                if elapsed >= next_sample:
+                    index.add_sample(line_offset, extrusion, elapsed)
+                    next_sample = elapsed + cls.SAMPLE_TIME
+                if command in ("G0", "G1", "G2", "G3"):
+                    words = dict(WORD.findall(line))
+                    if "F" in words:
+                        feedrate = float(words["F"]) or feedrate
+                    distance = 0.0
+                    for axis, letter in enumerate("XYZ"):
+                        if letter in words:
+                            value = float(words[letter])
+                            target = value if absolute else pos[axis] + value
+                            distance += (target - pos[axis]) ** 2
+                            pos[axis] = target
+                    delta_e = 0.0
+                    if "E" in words:
+                        value = float(words["E"])
+                        delta_e = value - pos[3] if absolute_e else value
+                        pos[3] = value if absolute_e else pos[3] + value
+                    distance = max(math.sqrt(distance), abs(delta_e))
+                    duration = distance / (feedrate / 60.0)
+                    elapsed += duration
+                    if delta_e > 0:
+                        extrusion += delta_e
+                        close_quiet(line_offset)
+                        quiet_start = None
+                    else:
+                        if quiet_start is None:
+                            quiet_start, quiet_time = line_offset, 0.0
+                        quiet_time += duration
+                elif command == "G4":
+                    words = dict(WORD.findall(line[2:]))
+                    duration = (float(words.get("S", 0)) +
+                                float(words.get("P", 0)) / 1000.0)
+                    elapsed += duration
+                    if quiet_start is None:
+                        quiet_start, quiet_time = line_offset, 0.0
+                    quiet_time += duration
+                elif command in WAIT_COMMANDS:
+                    if quiet_start is None:
+                        quiet_start = line_offset
+                    quiet_time = math.inf
+                elif command == "G90":
+                    absolute = absolute_e = True
+                elif command == "G91":
+                    absolute = absolute_e = False
+                elif command == "M82":
+                    absolute_e = True
+                elif command == "M83":
+                    absolute_e = False
+                elif command == "G92":
+                    for axis, letter in enumerate("XYZE"):
+                        match = re.search(letter + r"([-+]?\d*\.?\d+)", line)
+                        if match:
+                            pos[axis] = float(match.group(1))
+
+        close_quiet(offset)
+        index.add_sample(offset, extrusion, elapsed)
+        return index
+
+    def add_sample(self, offset, extrusion, elapsed):
+        self.offsets.append(offset)
+        self.extrusion.append(extrusion)
+        self.times.append(elapsed)
+
+    def add_quiet(self, start, end, duration):
+        self.quiet_starts.append(start)
+        self.quiet_ends.append(end)
+        self.quiet_durations.append(duration)
+
+    def _sample(self, offset):
+        return max(bisect.bisect_right(self.offsets, offset) - 1, 0)
+
+    def expected_extrusion(self, start, end):
+        """Filament (mm) expected between two file positions."""
+        if not self.offsets:
+            return 0.0
+        return (self.extrusion[self._sample(end)] -
+                self.extrusion[self._sample(start)])
+
+    def expected_time(self, start, end):
+        """Print time (s) expected between two file positions."""
+        if not self.offsets:
+            return 0.0
+        return self.times[self._sample(end)] - self.times[self._sample(start)]
+
+    def offset_before(self, offset, duration):
+        """File position ``duration`` seconds of printing before ``offset``."""
+        if not self.offsets:
+            return offset
+        n = bisect.bisect_left(self.times,
+                               self.times[self._sample(offset)] - duration)
+        return self.offsets[n]
+
+    def time_to_extrude(self, offset, length):
+        """Print time (s) from ``offset`` until ``length`` mm of filament
+        are expected, inf if the file ends before."""
+        if not self.offsets:
+            return math.inf
+        n = self._sample(offset)
+        m = bisect.bisect_left(self.extrusion, self.extrusion[n] + length)
+        if m == len(self.extrusion):
+            return math.inf
+        return self.times[m] - self.times[n]
+
+    def quiet_time(self, offset):
+        """Time left in the quiet window containing ``offset``, or 0."""
+        n = bisect.bisect_right(self.quiet_starts, offset) - 1
+        if n >= 0 and offset <= self.quiet_ends[n]:
+            # The line before ``offset`` is still running
+            start = self.quiet_starts[n]
+            elapsed = self.expected_time(start, max(offset - 1, start))
+            return max(self.quiet_durations[n] - elapsed, 0.0)
+        return 0.0
+
+    def save(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.MAGIC)
+            array("q", [len(self.offsets), len(self.quiet_starts)]).tofile(f)
+            for values in (self.offsets, self.extrusion, self.times,
+                           self.quiet_starts, self.quiet_ends,
+                           self.quiet_durations):
+                values.tofile(f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with open(path, "rb") as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError("Not a G-code index: %s" % path)
+            counts = array("q")
+            counts.fromfile(f, 2)
+            samples, quiet = counts
+            for values in (index.offsets, index.extrusion, index.times):
+                values.fromfile(f, samples)
+            for values in (index.quiet_starts, index.quiet_ends,
+                           index.quiet_durations):
+                values.fromfile(f, quiet)
+        return index
+
+
+def _stamp(path):
+    """Modification time and size of the file at ``path``, None if gone."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class GcodeIndexer:
+    """Builds indexes on one background thread and caches them on disk.
+
+    The last ``MAX_INDEXES`` requested are kept in memory, each with the
+    modification time and size of its file, so that a file uploaded again
+    under the same name is indexed again.
+    """
+
+    MAX_INDEXES = 8
+
+    def __init__(self, cache_folder, logger):
+        self._cache_folder = cache_folder
+        self._logger = logger
+        self._indexes = {}    # path -> (stamp, index or None while queued)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._work,
+                                        name="BovineGcodeIndexer", daemon=True)
+        self._thread.start()
+
+    def request(self, path):
+        """Index ``path`` in the background unless it is already known."""
+        stamp = _stamp(path)
+        if stamp is None:
+            return
+        with self._lock:
+            entry = self._indexes.pop(path, None)
+            if entry is not None and entry[0] == stamp:
+                self._indexes[path] = entry     # most recently used
+                return
+            self._indexes[path] = (stamp, None)
+            while len(self._indexes) > self.MAX_INDEXES:
+                del self._indexes[next(iter(self._indexes))]
+        self._queue.put((path, stamp))
+
+    def get(self, path):
+        """Return the index of ``path`` if it is ready, else None."""
+        entry = self._indexes.get(path)
+        return entry[1] if entry is not None else None
+
+    def forget(self, path=None):
+        """Drop the index of ``path``, or of the files changed on disk."""
+        with self._lock:
+            if path is not None:
+                self._indexes.pop(path, None)
+                return
+            for path, (stamp, index) in list(self._indexes.items()):
+                if _stamp(path) != stamp:
+                    del self._indexes[path]
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            path, stamp = item
+            try:
+                index = self._load_or_scan(path)
+            except Exception:
+                self._logger.exception("Could not index %s" % path)
+                with self._lock:
+                    if self._indexes.get(path) == (stamp, None):
+                        del self._indexes[path]
+                continue
+            with self._lock:
+                if self._indexes.get(path) == (stamp, None):
+                    self._indexes[path] = (stamp, index)
+
+    def _load_or_scan(self, path):
+        cache = os.path.join(self._cache_folder, file_hash(path) + ".idx")
+        if os.path.exists(cache):
+            try:
+                return GcodeIndex.load(cache)
+            except (OSError, ValueError, EOFError):
+                self._logger.warn("Discarding bad index cache %s" % cache)
+        index = GcodeIndex.scan(path)
+        os.makedirs(self._cache_folder, exist_ok=True)
+        index.save(cache)
+        self._logger.info("Indexed %s: %i samples, %i quiet windows"
+                          % (path, len(index.offsets), len(index.quiet_starts)))
+        return index
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join(1.0)
@@ -0,0 +1,460 @@
+"""GPIO access for the sensor input and the alarm output.
+
+A backend delivers the edges of an input pin as monotonic timestamps into
+an EdgeBuffer, so the detectors never depend on how the edges were read:
+
+- ``rpi``: RPi.GPIO, one callback per edge timed in user space and
+  debounced by the EdgeBuffer.
+- ``gpiod``: Linux GPIO character device (libgpiod v2). Edges are read
+  in batches with kernel timestamps and debounced by the kernel.
+- ``sampler``: edges sampled by the sampler daemon in another process
+  (``sampler.py``) and read from its shared memory segment.
+- ``mock``: in-process backend for tools and simulations, edges are
+  injected with ``emit``.
+"""
+import os
+import select
+import socket
+import threading
+from datetime import timedelta
+from time import monotonic, sleep
+from .edge_buffer import EdgeReader
+from .clock import MONOTONIC
+
+BOARD = 0
+BCM = 1
+
+# Physical pin -> BCM channel on the 40-pin header
+BOARD_TO_BCM = {
+    3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27, 15: 22,
+    16: 23, 18: 24, 19: 10, 21: 9, 22: 25, 23: 11, 24: 8, 26: 7, 27: 0,
+    28: 1, 29: 5, 31: 6, 32: 12, 33: 13, 35: 19, 36: 16, 37: 26, 38: 20,
+    40: 21,
+}
+
+
+class GPIOBackend:
+    """Base class of the GPIO backends."""
+
+    name = None
+
+    def __init__(self, logger):
+        self._logger = logger
+        self.mode = BCM
+        # Optional histogram of the time from an edge to its delivery, for
+        # the backends that get the edge time from elsewhere (kernel)
+        self.edge_latency = None
+
+    def set_mode(self, mode):
+        """Select BOARD (0) or BCM (1) pin numbering."""
+        self.mode = mode
+
+    def add_edge_detection(self, pin, edges, debounce=0):
+        """Record both edges of input ``pin`` into the EdgeBuffer ``edges``.
+
+        ``debounce`` is the minimum time in seconds between two edges.
+        Backends filter the bounces in the kernel when they can, otherwise
+        the EdgeBuffer rejects them by timestamp (and counts them).
+        """
+        raise NotImplementedError
+
+    def remove_edge_detection(self, pin):
+        raise NotImplementedError
+
+    def input(self, pin):
+        """Level of an input ``pin`` with edge detection."""
+        raise NotImplementedError
+
+    def output(self, pin, value):
+        """Drive output ``pin`` high or low, set up on first use."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class RPiGPIOBackend(GPIOBackend):
+    name = "rpi"
+
+    def __init__(self, logger):
+        GPIOBackend.__init__(self, logger)
+        import RPi.GPIO as GPIO
+        self._gpio = GPIO
+        self._inputs = set()
+        self._outputs = set()
+        self._logger.info("Running RPi.GPIO version '%s'" % GPIO.VERSION)
+        version = tuple(int(n) for n in GPIO.VERSION.split(".")[:2])
+        if version < (0, 6):    # Need >= 0.6 for edge detection
+            raise Exception("RPi.GPIO must be greater than 0.6")
+        GPIO.setwarnings(False)     # Disable GPIO warnings
+
+    def set_mode(self, mode):
+        gpio = self._gpio
+        channels = self._inputs | self._outputs
+        if channels and mode != self.mode:
+            # RPi.GPIO refuses another numbering while channels are set up
+            gpio.cleanup(sorted(channels))
+            self._inputs.clear()
+        if mode == BOARD:
+            gpio.setmode(gpio.BOARD)
+        else:
+            gpio.setmode(gpio.BCM)
+        GPIOBackend.set_mode(self, mode)
+        self._outputs.clear()
+
+    def add_edge_detection(self, pin, edges, debounce=0):
+        gpio = self._gpio
+        gpio.setup(pin, gpio.IN)
+        self._inputs.add(pin)
+        # Remove event first, because it might have been in use already
+        self.remove_edge_detection(pin)
+        # Not RPi.GPIO bouncetime, which counts nothing and has a 1 ms step
+        edges.set_debounce(debounce)
+        push = edges.push
+        gpio.add_event_detect(pin, gpio.BOTH,
+                              callback=lambda channel: push(monotonic()))
+
+    def remove_edge_detection(self, pin):
+        try:
+            self._gpio.remove_event_detect(pin)
+        except (ValueError, RuntimeError):
+            self._logger.warn("Pin %i not used before" % pin)
+
+    def input(self, pin):
+        return bool(self._gpio.input(pin))
+
+    def output(self, pin, value):
+        if pin not in self._outputs:
+            self._gpio.setup(pin, self._gpio.OUT)
+            self._outputs.add(pin)
+        self._gpio.output(pin, bool(value))
+
+
+class GpiodBackend(GPIOBackend):
+    """libgpiod v2 backend.
+
+    All input lines are served by one reader thread blocked in ``select``
+    on the line request descriptors, woken through a pipe when the set of
+    lines changes.
+    """
+
+    name = "gpiod"
+    CONSUMER = "bovine_filament_sensor"
+
+    def __init__(self, logger, chip="/dev/gpiochip0"):
+        GPIOBackend.__init__(self, logger)
+        import gpiod
+        from gpiod.line import Clock, Direction, Edge, Value
+        self._gpiod = gpiod
+        self._Clock, self._Direction = Clock, Direction
+        self._Edge, self._Value = Edge, Value
+        self.chip = chip
+        self._lock = threading.Lock()
+        self._inputs = {}     # offset -> (request, edges)
+        self._outputs = {}    # offset -> request
+        self._wake_r, self._wake_w = os.pipe()
+        self._closed = False
+        self._thread = threading.Thread(target=self._read_events,
+                                        name="BovineGpiodReader", daemon=True)
+        self._thread.start()
+        self._logger.info("Using GPIO character device %s" % chip)
+
+    def _offset(self, pin):
+        if self.mode == BOARD:
+            try:
+                return BOARD_TO_BCM[pin]
+            except KeyError:
+                raise ValueError("Board pin %i is not a GPIO" % pin)
+        return pin
+
+    def add_edge_detection(self, pin, edges, debounce=0):
+        offset = self._offset(pin)
+        self.remove_edge_detection(pin)
+        edges.set_debounce(0)
+        settings = self._gpiod.LineSettings(
+            direction=self._Direction.INPUT,
+            edge_detection=self._Edge.BOTH,
+            event_clock=self._Clock.MONOTONIC,
+            debounce_period=timedelta(seconds=debounce))
+        request = self._gpiod.request_lines(self.chip, consumer=self.CONSUMER,
+                                            config={offset: settings})
+        with self._lock:
+            self._inputs[offset] = (request, edges)
+        os.write(self._wake_w, b"x")
+
+    def remove_edge_detection(self, pin):
+        with self._lock:
+            entry = self._inputs.pop(self._offset(pin), None)
+        if entry is not None:
+            os.write(self._wake_w, b"x")
+            entry[0].release()
+
+    def input(self, pin):
+        offset = self._offset(pin)
+        request = self._inputs[offset][0]
+        return request.get_value(offset) == self._Value.ACTIVE
+
+    def output(self, pin, value):
+        offset = self._offset(pin)
+        request = self._outputs.get(offset)
+        if request is None:
+            settings = self._gpiod.LineSettings(
+                direction=self._Direction.OUTPUT,
+                output_value=self._Value.INACTIVE)
+            request = self._gpiod.request_lines(self.chip,
+                                                consumer=self.CONSUMER,
+                                                config={offset: settings})
+            self._outputs[offset] = request
+        request.set_value(offset, self._Value.ACTIVE if value
+                          else self._Value.INACTIVE)
+
+    def _read_events(self):
+        while not self._closed:
+            with self._lock:
+                requests = {request.fd: (request, edges)
+                            for request, edges in self._inputs.values()}
+            try:
+                ready, _, _ = select.select([self._wake_r] + list(requests),
+                                            [], [])
+            except (OSError, ValueError):
+                continue    # a request was released since the snapshot
+            for fd in ready:
+                if fd == self._wake_r:
+                    os.read(self._wake_r, 64)
+                    continue
+                request, edges = requests[fd]
+                try:
+                    events = request.read_edge_events()
+                except (OSError, ValueError):
+                    continue    # released while waiting
+                times = [event.timestamp_ns * 1e-9 for event in events]
+                edges.extend(times)
+                if self.edge_latency is not None and times:
+                    self.edge_latency.observe(monotonic() - times[0])
+
+    def close(self):
+        self._closed = True
+        os.write(self._wake_w, b"x")
+        self._thread.join(1.0)
+        with self._lock:
+            requests = [request for request, edges in self._inputs.values()]
+            requests += list(self._outputs.values())
+            self._inputs.clear()
+            self._outputs.clear()
+        for request in requests:
+            request.release()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+
+class SamplerBackend(GPIOBackend):
+    """Edges of the sampler daemon, read from its shared memory segment.
+
+    A poller thread copies the new edges of each pin into the EdgeBuffer of
+    the sensor every ``POLL`` seconds: a memory read, no system call per
+    edge. The segment is attached again when the daemon restarts (its
+    heartbeat stops). Outputs go through the command socket of the daemon.
+    """
+
+    name = "sampler"
+    POLL = 0.005
+
+    def __init__(self, logger, segment="bovine_sampler", socket_path=None):
+        GPIOBackend.__init__(self, logger)
+        from . import sampler
+        self._sampler = sampler
+        self.segment = segment
+        self.socket_path = socket_path
+        self._lock = threading.Lock()
+        self._inputs = {}     # pin -> [view, reader, edges, debounce]
+        self._socket = None
+        self._attached = None
+        self._attach()
+        self._closed = False
+        self._thread = threading.Thread(target=self._poll,
+                                        name="BovineSamplerReader",
+                                        daemon=True)
+        self._thread.start()
+
+    def _attach(self):
+        self._attached = self._sampler.SamplerSegment(self.segment)
+        self._logger.info("Using sampler segment '%s' (GPIO %s)"
+                          % (self.segment, ", ".join(
+                              str(pin) for pin in self._attached.pins())))
+
+    def _bcm(self, pin):
+        if self.mode == BOARD:
+            try:
+                return BOARD_TO_BCM[pin]
+            except KeyError:
+                raise ValueError("Board pin %i is not a GPIO" % pin)
+        return pin
+
+    def add_edge_detection(self, pin, edges, debounce=0):
+        # The daemon filters bounces with its own --debounce, this one
+        # applies on top of it
+        edges.set_debounce(debounce)
+        view = self._attached.view(self._bcm(pin))
+        with self._lock:
+            self._inputs[pin] = [view, EdgeReader(view), edges]
+
+    def remove_edge_detection(self, pin):
+        with self._lock:
+            entry = self._inputs.pop(pin, None)
+        if entry is not None:
+            entry[0].release()
+
+    def input(self, pin):
+        return self._inputs[pin][0].level()
+
+    def output(self, pin, value):
+        if not self.socket_path:
+            raise RuntimeError("Outputs need the socket of the sampler")
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(self.socket_path)
+        try:
+            self._socket.sendall(b"output %i %i\n" % (self._bcm(pin),
+                                                       bool(value)))
+        except OSError:
+            self._socket.close()
+            self._socket = None
+            raise
+
+    def _poll(self):
+        stale = self._sampler.STALE
+        next_check = 0.0
+        while not self._closed:
+            with self._lock:
+                for view, reader, edges in self._inputs.values():
+                    times = reader.read()
+                    if reader.dropped:
+                        # Overwritten in the ring of the daemon
+                        edges.dropped += reader.dropped
+                        reader.dropped = 0
+                    if times:
+                        edges.extend(times)
+                        if self.edge_latency is not None:
+                            self.edge_latency.observe(monotonic() - times[0])
+                now = monotonic()
+                if now >= next_check:
+                    next_check = now + stale
+                    if now - self._attached.heartbeat > stale:
+                        self._reattach()
+            sleep(self.POLL)
+
+    def _reattach(self):
+        """Follow a restarted daemon (lock held)."""
+        try:
+            segment = self._sampler.SamplerSegment(self.segment)
+        except (OSError, ValueError):
+            return      # still down, the detectors see no motion
+        if monotonic() - segment.heartbeat > self._sampler.STALE:
+            segment.close()
+            return
+        self._logger.warn("Sampler restarted, attaching its new segment")
+        old, self._attached = self._attached, segment
+        for pin, entry in list(self._inputs.items()):
+            entry[0].release()
+            try:
+                view = segment.view(self._bcm(pin))
+            except ValueError as e:
+                self._logger.error(str(e))
+                del self._inputs[pin]
+                continue
+            entry[0], entry[1] = view, EdgeReader(view)
+        old.close()
+
+    def close(self):
+        self._closed = True
+        self._thread.join(1.0)
+        with self._lock:
+            for entry in self._inputs.values():
+                entry[0].release()
+            self._inputs.clear()
+        if self._socket is not None:
+            self._socket.close()
+        self._attached.close()
+
+
+class MockBackend(GPIOBackend):
+    """In-process backend, edges are injected with ``emit``."""
+
+    name = "mock"
+
+    def __init__(self, logger, clock=MONOTONIC):
+        GPIOBackend.__init__(self, logger)
+        self.clock = clock
+        self.inputs = {}
+        self.levels = {}
+
+    def add_edge_detection(self, pin, edges, debounce=0):
+        edges.set_debounce(debounce)
+        self.inputs[pin] = edges
+
+    def remove_edge_detection(self, pin):
+        self.inputs.pop(pin, None)
+
+    def input(self, pin):
+        return self.levels.get(pin, False)
+
+    def output(self, pin, value):
+        self.levels[pin] = bool(value)
+
+    def emit(self, pin, timestamps=None):
+        """Inject one edge now, or a batch of edges at ``timestamps``."""
+        edges = self.inputs.get(pin)
+        if edges is None:
+            return
+        if timestamps is None:
+            edges.push(self.clock.monotonic())
+        else:
+            edges.extend(timestamps)
+
+
+BACKENDS = {
+    RPiGPIOBackend.name: RPiGPIOBackend,
+    GpiodBackend.name: GpiodBackend,
+    SamplerBackend.name: SamplerBackend,
+    MockBackend.name: MockBackend,
+}
+
+
+def create_backend(name, logger, **kwargs):
+    """Instantiate the backend ``name`` ("rpi", "gpiod", "sampler" or
+    "mock")."""
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown GPIO backend '%s'" % name)
+    if backend is GpiodBackend:
+        return backend(logger, chip=kwargs.get("chip", "/dev/gpiochip0"))
+    if backend is SamplerBackend:
+        return backend(logger, segment=kwargs.get("segment", "bovine_sampler"),
+                       socket_path=kwargs.get("socket_path"))
+    if backend is MockBackend:
+        return backend(logger, clock=kwargs.get("clock", MONOTONIC))
+    return backend(logger)
+
+
+def available_backends():
+    """Names of the hardware backends whose library can be imported."""
+    names = []
+    try:
+        import RPi.GPIO  # noqa: F401
+        names.append(RPiGPIOBackend.name)
+    except (ImportError, RuntimeError):
+        pass
+    try:
+        import gpiod
+        if hasattr(gpiod, "request_lines"):     # libgpiod v2 bindings
+            names.append(GpiodBackend.name)
+    except ImportError:
+        pass
+    try:
+        from multiprocessing import shared_memory  # noqa: F401
+        if names:   # the daemon uses one of the others
+            names.append(SamplerBackend.name)
+    except ImportError:
+        pass
+    return names
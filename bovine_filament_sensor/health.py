@@ -0,0 +1,134 @@
+class RunningStats:
+    """Mean and variance in constant memory (Welford)."""
+
+    __slots__ = ("count", "mean", "_m2")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value):
+        self.count = n = self.count + 1
+        delta = value - self.mean
+        self.mean += delta / n
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def stdev(self):
+        return (self._m2 / (self.count - 1)) ** 0.5 if self.count > 1 else 0.0
+
+    def to_dict(self):
+        return dict(count=self.count, mean=self.mean, stdev=self.stdev)
+
+
+class SensorHealth:
+    """Running statistics of the edges of one sensor.
+
+    Edges alternate between rising and falling, so with the level before
+    the first edge each interval is a high or a low pulse. Pulse widths
+    (high) and intervals go into RunningStats, the duty cycle of each
+    period (two consecutive intervals) into an EWMA. Intervals over
+    ``MAX_INTERVAL`` are the filament standing still, not sensor timing.
+
+    A dirty optocoupler or a loose wheel skews the duty cycle. A line
+    stuck at one level only passes short glitches, which look like motion
+    to the detection but give a duty cycle close to 0 or 1. A line stuck
+    without any glitch gives no period at all: ``commanded`` counts the
+    filament commanded since the last edge instead.
+    """
+
+    ALPHA = 0.02            # EWMA weight of a period
+    MIN_PERIODS = 100       # before any warning
+    MAX_INTERVAL = 2.0
+    SKEWED = 0.2            # duty cycle outside [SKEWED, 1 - SKEWED]
+    STUCK = 0.03
+    BOUNCING = 0.2          # share of the edges rejected as bounces
+    SILENT = 100.0          # mm commanded without an edge
+
+    def __init__(self, level):
+        self.level = level      # level after the last edge
+        self.widths = RunningStats()
+        self.intervals = RunningStats()
+        self.duty_cycle = None
+        self.periods = 0
+        self._last = None
+        self._previous = 0.0    # interval before the last one, 0 if none
+        self.unseen = 0.0       # mm commanded since the last edge
+        self._total = None
+
+    def resync(self, level):
+        """Edges were lost: restart from the current ``level``."""
+        self.level = level
+        self._last = None
+        self._previous = 0.0
+
+    def add(self, times):
+        """Account a batch of edge timestamps."""
+        level = self.level
+        last = self._last
+        previous = self._previous
+        alpha = self.ALPHA
+        for t in times:
+            if last is not None:
+                interval = t - last
+                if interval > self.MAX_INTERVAL:
+                    previous = 0.0
+                else:
+                    self.intervals.add(interval)
+                    if level:
+                        self.widths.add(interval)
+                    if previous:
+                        # The interval that ends here had the level of the
+                        # last edge
+                        high = interval if level else previous
+                        duty = high / (previous + interval)
+                        if self.duty_cycle is None:
+                            self.duty_cycle = duty
+                        else:
+                            self.duty_cycle += alpha * (duty - self.duty_cycle)
+                        self.periods += 1
+                    previous = interval
+            last = t
+            level = not level
+        self.level = level
+        self._last = last
+        self._previous = previous
+
+    def commanded(self, total, moved):
+        """Account the filament commanded to the tool, ``total`` mm so far,
+        ``moved`` if edges came since the last call."""
+        if moved:
+            self.unseen = 0.0
+        elif self._total is not None and total > self._total:
+            self.unseen += total - self._total
+        self._total = total
+
+    def warnings(self, edges):
+        """Health problems seen so far, ``edges`` is the EdgeBuffer."""
+        warnings = []
+        if self.unseen >= self.SILENT:
+            # Constant text: the warning is only reported when it changes
+            warnings.append("No edge for over %.0f mm of filament: line stuck "
+                            "%s or filament not moving"
+                            % (self.SILENT, "high" if self.level else "low"))
+        total = edges.count + edges.rejected
+        if total >= self.MIN_PERIODS and edges.rejected > self.BOUNCING * total:
+            warnings.append("%.0f%% of the edges are bounces"
+                            % (100.0 * edges.rejected / total))
+        duty = self.duty_cycle
+        if self.periods < self.MIN_PERIODS or duty is None:
+            return warnings
+        if duty < self.STUCK or duty > 1 - self.STUCK:
+            warnings.append("Line stuck %s, its edges are glitches"
+                            % ("high" if duty > 0.5 else "low"))
+        elif duty < self.SKEWED or duty > 1 - self.SKEWED:
+            warnings.append("Duty cycle of %.0f%%, check the sensor wheel "
+                            "and optocoupler" % (100.0 * duty))
+        return warnings
+
+    def to_dict(self):
+        return dict(duty_cycle=self.duty_cycle, periods=self.periods,
+                    level=self.level, unseen=self.unseen,
+                    widths=self.widths.to_dict(),
+                    intervals=self.intervals.to_dict())
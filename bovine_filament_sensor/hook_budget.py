@@ -0,0 +1,56 @@
+from .clock import MONOTONIC
+
+
+class HookBudget:
+    """Watch the average cost per line of the G-code hook.
+
+    ``sample`` is fed with the duration of timed lines. When the moving
+    average goes over ``budget`` seconds the guard degrades and calls
+    ``callback(True, average)``. It recovers, calling ``callback(False,
+    average)``, once the average stays below ``recover`` times the budget
+    and it has been degraded for at least ``hold`` seconds, so a load
+    near the budget does not flip the mode on every line. Samples are
+    capped at ``OUTLIER`` times the budget: a line preempted by another
+    thread must not degrade the hook on its own.
+    """
+
+    OUTLIER = 4
+
+    def __init__(self, budget, callback, alpha=0.01, recover=0.5, hold=30.0,
+                 clock=MONOTONIC):
+        self.budget = budget
+        self.clock = clock
+        self.callback = callback
+        self.alpha = alpha
+        self.recover = recover
+        self.hold = hold
+        self.average = 0.0
+        self.degraded = False
+        self.changes = 0
+        self._since = 0.0
+
+    def sample(self, seconds):
+        if self.budget and seconds > self.budget * self.OUTLIER:
+            seconds = self.budget * self.OUTLIER
+        average = self.average + self.alpha * (seconds - self.average)
+        self.average = average
+        if not self.budget:
+            return
+        if not self.degraded:
+            if average > self.budget:
+                self._change(True)
+        elif (average < self.budget * self.recover and
+              self.clock.monotonic() - self._since >= self.hold):
+            self._change(False)
+
+    def reset(self):
+        """Forget the history (e.g. new print), back to the normal mode."""
+        self.average = 0.0
+        if self.degraded:
+            self._change(False)
+
+    def _change(self, degraded):
+        self.degraded = degraded
+        self.changes += 1
+        self._since = self.clock.monotonic()
+        self.callback(degraded, self.average)
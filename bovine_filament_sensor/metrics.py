@@ -0,0 +1,107 @@
+"""Always-on instrumentation rendered in the Prometheus text format.
+
+Counters and histograms are allocated once, so recording a value is an
+attribute increment or a ``bisect`` into fixed bucket bounds. Updates are
+not locked: concurrent increments from different threads may rarely lose
+a count, which is fine for monitoring.
+"""
+from bisect import bisect_left
+
+# Bucket upper bounds (seconds)
+MICRO_BUCKETS = (1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4,
+                 1e-3, 1e-2)
+MILLI_BUCKETS = (1e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2, 0.1, 0.5,
+                 1.0)
+
+
+class Counter:
+    __slots__ = ("name", "help", "value")
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        yield self.name, "", self.value
+
+
+class Histogram:
+    __slots__ = ("name", "help", "bounds", "counts", "sum")
+    type = "histogram"
+
+    def __init__(self, name, help, bounds):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(bounds)
+        # One more bucket for the values above the last bound (+Inf)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            yield self.name + "_bucket", '{le="%g"}' % bound, total
+        total += self.counts[-1]
+        yield self.name + "_bucket", '{le="+Inf"}', total
+        yield self.name + "_sum", "", self.sum
+        yield self.name + "_count", "", total
+
+
+class Collected:
+    """Metric whose samples are read from the plugin state on rendering.
+
+    ``collect()`` returns ``(labels, value)`` pairs, labels being a dict.
+    """
+
+    def __init__(self, name, help, type, collect):
+        self.name = name
+        self.help = help
+        self.type = type
+        self._collect = collect
+
+    def samples(self):
+        for labels, value in self._collect():
+            text = ",".join('%s="%s"' % item for item in sorted(labels.items()))
+            yield self.name, "{%s}" % text if text else "", value
+
+
+class Metrics:
+    """Registry of the metrics of the plugin."""
+
+    PREFIX = "bovine_"
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help):
+        return self._add(Counter(self.PREFIX + name, help))
+
+    def histogram(self, name, help, bounds=MILLI_BUCKETS):
+        return self._add(Histogram(self.PREFIX + name, help, bounds))
+
+    def collected(self, name, help, type, collect):
+        return self._add(Collected(self.PREFIX + name, help, type, collect))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("%s%s %r" % (name, labels, float(value)))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,184 @@
+import itertools
+import queue
+import threading
+from urllib.request import urlopen
+
+
+class ResponseAction:
+    """Something done when the sensor detects a problem.
+
+    ``run`` executes on a dispatcher worker and must return soon after the
+    ``cancelled`` event is set, which happens on cancellation or when the
+    action exceeds its ``timeout``. Only the ``notification`` actions are
+    cancelled when the filament moves again.
+    """
+
+    key = None
+    priority = 10
+    timeout = 10
+    notification = True
+
+    def run(self, cancelled):
+        raise NotImplementedError
+
+
+class PauseAction(ResponseAction):
+    """Send the pause command to the printer (always dispatched first).
+
+    A decided pause goes out even if the filament moves meanwhile.
+    """
+
+    key = "pause"
+    priority = 0
+    timeout = 5
+    notification = False
+
+    def __init__(self, printer, command):
+        self._printer = printer
+        self.command = command
+
+    def run(self, cancelled):
+        self._printer.commands(self.command)
+
+
+class BellAction(ResponseAction):
+    """Ring a local alarm by toggling a GPIO output pin."""
+
+    key = "bell"
+
+    def __init__(self, gpio, pin, on_time=1.0, off_time=0.5, repeat=25):
+        self._gpio = gpio
+        self.pin = pin
+        self.on_time = on_time
+        self.off_time = off_time
+        self.repeat = repeat
+        self.timeout = repeat * (on_time + off_time) + 1
+
+    def run(self, cancelled):
+        try:
+            for n in range(self.repeat):
+                self._gpio.output(self.pin, True)
+                if cancelled.wait(self.on_time):
+                    break
+                self._gpio.output(self.pin, False)
+                if cancelled.wait(self.off_time):
+                    break
+        finally:
+            self._gpio.output(self.pin, False)
+
+
+class RemoteAlarmAction(ResponseAction):
+    """Trigger a remote alarm (e.g. the Wi-Fi cow bell) with an HTTP GET."""
+
+    key = "remote"
+    timeout = 5
+
+    def __init__(self, url):
+        self.url = url
+
+    def run(self, cancelled):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            response.read()
+
+
+class ResponseDispatcher:
+    """Run response actions on a small pool of worker threads.
+
+    Actions are queued by priority, so the pause command goes out before
+    any alarm. An action is ignored while another one with the same key is
+    queued or running, and running actions can be cancelled, e.g. when
+    the filament moves again. With the virtual clock of a simulation the
+    actions run right away on the dispatching thread, at the virtual time
+    of the decision.
+    """
+
+    def __init__(self, logger, scheduler, workers=2, queue_size=16,
+                 latency=None):
+        """``latency`` is an optional histogram of the time from dispatch
+        to the start of the action."""
+        self._logger = logger
+        self._latency = latency
+        self._scheduler = scheduler
+        self._clock = scheduler.clock
+        self._queue = queue.PriorityQueue(queue_size)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._active = {}
+        if self._clock.virtual:
+            workers = 0
+        self._workers = [threading.Thread(target=self._work,
+                                          name="BovineResponse%i" % n,
+                                          daemon=True)
+                         for n in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def dispatch(self, action):
+        """Queue an action, return False if it was deduplicated or dropped."""
+        with self._lock:
+            if action.key in self._active:
+                return False
+            cancelled = threading.Event()
+            self._active[action.key] = (action, cancelled)
+        item = (action.priority, next(self._counter), action, cancelled,
+                self._clock.monotonic())
+        if not self._workers:
+            self._run(*item)
+            return True
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self._logger.error("Response queue full, dropping %s" % action.key)
+            self._done(action)
+            return False
+        return True
+
+    def cancel(self, key=None):
+        """Cancel the action with ``key``, or all the notifications."""
+        with self._lock:
+            if key is None:
+                events = [cancelled for action, cancelled
+                          in self._active.values() if action.notification]
+            elif key in self._active:
+                events = [self._active[key][1]]
+            else:
+                events = []
+        for cancelled in events:
+            cancelled.set()
+
+    def _done(self, action):
+        with self._lock:
+            self._active.pop(action.key, None)
+
+    def _work(self):
+        while True:
+            priority, seq, action, cancelled, queued = self._queue.get()
+            if action is None:
+                return
+            self._run(priority, seq, action, cancelled, queued)
+
+    def _run(self, priority, seq, action, cancelled, queued):
+        if self._latency is not None:
+            self._latency.observe(self._clock.monotonic() - queued)
+        if cancelled.is_set():
+            self._done(action)
+            return
+        timer = self._scheduler.call_later(action.timeout, cancelled.set)
+        try:
+            action.run(cancelled)
+        except Exception:
+            self._logger.exception("Response %s failed" % action.key)
+        finally:
+            timer.cancel()
+            self._done(action)
+
+    def stop(self, timeout=1.0):
+        """Cancel everything and stop the workers."""
+        with self._lock:
+            events = [cancelled for action, cancelled in self._active.values()]
+        for cancelled in events:
+            cancelled.set()
+        for worker in self._workers:
+            self._queue.put((-1, next(self._counter), None, None, None))
+        for worker in self._workers:
+            worker.join(timeout)
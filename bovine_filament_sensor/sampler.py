@@ -0,0 +1,387 @@
+#!/usr/bin/python3
+"""Out-of-process GPIO sampler.
+
+A small daemon owns the sensor lines through the ``rpi`` or ``gpiod``
+backend and writes their edges into a ``multiprocessing.shared_memory``
+segment, so sensor timing does not compete for the GIL of OctoPrint
+(file uploads, timelapse rendering, other plugins). The ``sampler`` GPIO
+backend of the plugin, and of every other OctoPrint instance on the
+host, polls the segment: reading edges costs no system call per edge.
+
+The segment starts with ``HEADER`` (magic, slots, ring size, heartbeat)
+followed by one slot per pin: ``SLOT`` (BCM pin, level before the first
+edge, edge count, rejected bounces) and a ring of ``size`` edge
+timestamps, written like an EdgeBuffer. The heartbeat is the monotonic
+time of the last pass of the daemon loop.
+
+With ``--socket`` the daemon also listens on a Unix socket for line
+commands: ``watch`` streams ``edge <pin> <time>`` lines, and
+``output <pin> <0|1>`` drives one of the ``--outputs`` pins (the alarm
+bell). A bad command is logged and ignored.
+
+    $ python3 sampler.py --backend gpiod --pins 24,25 --outputs 21 --socket /tmp/bovine_sampler.sock
+"""
+import argparse
+import logging
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+
+if __package__:
+    from .edge_buffer import EdgeBuffer
+    from .gpio_backend import BCM, BOARD_TO_BCM, create_backend
+else:
+    # Run as a script: these modules do not need OctoPrint, so load them
+    # without running the package __init__
+    import types
+    package = types.ModuleType("bovine_filament_sensor")
+    package.__path__ = [os.path.dirname(os.path.abspath(__file__))]
+    sys.modules.setdefault("bovine_filament_sensor", package)
+    from bovine_filament_sensor.edge_buffer import EdgeBuffer
+    from bovine_filament_sensor.gpio_backend import (BCM, BOARD_TO_BCM,
+                                                     create_backend)
+
+MAGIC = b"BFSSMP01"
+HEADER = struct.Struct("<8sIId")    # magic, slots, ring size, heartbeat
+SLOT = struct.Struct("<iiQQ")       # pin, level, count, rejected
+COUNT = struct.Struct("<Q")
+COUNT_OFFSET = 8                    # in SLOT
+REJECTED_OFFSET = 16
+HEARTBEAT_OFFSET = 16               # in HEADER
+
+DEFAULT_NAME = "bovine_sampler"
+# Seconds between two passes of the daemon loop, and without a heartbeat
+# before the readers consider the daemon gone
+POLL = 0.05
+STALE = 2.0
+
+
+def _attach(name):
+    """Open an existing segment without handing it to the resource
+    tracker, which would unlink it when this process exits."""
+    from multiprocessing import shared_memory
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:   # before Python 3.13
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class SamplerSegment:
+    """Shared memory segment of the sampler.
+
+    ``pins`` creates it for these BCM pins (daemon), otherwise the
+    segment ``name`` of a running daemon is attached (readers).
+    """
+
+    def __init__(self, name=DEFAULT_NAME, pins=None, size=4096):
+        from multiprocessing import shared_memory
+        if pins is None:
+            self._shm = _attach(name)
+            magic, slots, size, heartbeat = HEADER.unpack_from(self._shm.buf)
+            if magic != MAGIC:
+                self._shm.close()
+                raise ValueError("%s is not a sampler segment" % name)
+        else:
+            if size & (size - 1):
+                raise ValueError("Ring size must be a power of two")
+            slots = len(pins)
+            length = HEADER.size + slots * (SLOT.size + 8 * size)
+            try:
+                self._shm = shared_memory.SharedMemory(name, create=True,
+                                                       size=length)
+            except FileExistsError:
+                # Left over by a daemon that did not exit cleanly
+                shared_memory.SharedMemory(name).unlink()
+                self._shm = shared_memory.SharedMemory(name, create=True,
+                                                       size=length)
+            for n, pin in enumerate(pins):
+                SLOT.pack_into(self._shm.buf, self._slot(n, size), pin, 0,
+                               0, 0)
+            HEADER.pack_into(self._shm.buf, 0, MAGIC, slots, size,
+                             time.monotonic())
+        self.name = name
+        self.slots = slots
+        self.size = size
+        self.buf = self._shm.buf
+
+    def _slot(self, n, size=None):
+        return HEADER.size + n * (SLOT.size + 8 * (size or self.size))
+
+    def pins(self):
+        return [SLOT.unpack_from(self.buf, self._slot(n))[0]
+                for n in range(self.slots)]
+
+    def find(self, pin):
+        """Offset of the slot of BCM ``pin``."""
+        try:
+            return self._slot(self.pins().index(pin))
+        except ValueError:
+            raise ValueError("The sampler does not watch GPIO %i" % pin)
+
+    @property
+    def heartbeat(self):
+        return struct.unpack_from("<d", self.buf, HEARTBEAT_OFFSET)[0]
+
+    def beat(self):
+        struct.pack_into("<d", self.buf, HEARTBEAT_OFFSET, time.monotonic())
+
+    def writer(self, pin):
+        """SharedEdgeBuffer of ``pin`` (daemon)."""
+        return SharedEdgeBuffer(self.buf, self.find(pin), self.size)
+
+    def set_level(self, pin, level):
+        struct.pack_into("<i", self.buf, self.find(pin) + 4, int(level))
+
+    def view(self, pin):
+        """Read-only SharedEdgeView of ``pin``."""
+        return SharedEdgeView(self.buf, self.find(pin), self.size)
+
+    def close(self):
+        self.buf = None
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
+
+
+class SharedEdgeBuffer(EdgeBuffer):
+    """EdgeBuffer whose ring and counters live in a sampler slot."""
+
+    def __init__(self, buf, offset, size):
+        self._buf = buf
+        self._offset = offset
+        EdgeBuffer.__init__(self, size)
+        start = offset + SLOT.size
+        self._times = buf[start:start + 8 * size].cast("d")
+
+    @property
+    def count(self):
+        return self._count
+
+    @count.setter
+    def count(self, n):
+        # The timestamp is written before the count that publishes it
+        self._count = n
+        COUNT.pack_into(self._buf, self._offset + COUNT_OFFSET, n)
+
+    @property
+    def rejected(self):
+        return self._rejected
+
+    @rejected.setter
+    def rejected(self, n):
+        self._rejected = n
+        COUNT.pack_into(self._buf, self._offset + REJECTED_OFFSET, n)
+
+
+class SharedEdgeView:
+    """Read side of a sampler slot, consumed through an EdgeReader."""
+
+    def __init__(self, buf, offset, size):
+        self._buf = buf
+        self._offset = offset
+        self.size = size
+        self._mask = size - 1
+        start = offset + SLOT.size
+        self._times = buf[start:start + 8 * size].cast("d")
+        self.dropped = 0
+
+    @property
+    def count(self):
+        return COUNT.unpack_from(self._buf, self._offset + COUNT_OFFSET)[0]
+
+    @property
+    def rejected(self):
+        return COUNT.unpack_from(self._buf, self._offset + REJECTED_OFFSET)[0]
+
+    def level(self):
+        """Current level: the initial one toggled by every edge."""
+        pin, level, count, rejected = SLOT.unpack_from(self._buf, self._offset)
+        return bool(level ^ (count & 1))
+
+    def release(self):
+        self._times.release()
+
+
+class Sampler:
+    """The daemon: GPIO backend, shared segment and command socket."""
+
+    def __init__(self, backend, pins, logger, name=DEFAULT_NAME, size=4096,
+                 debounce=0.0, socket_path=None, outputs=()):
+        self._backend = backend
+        self._logger = logger
+        self._outputs = frozenset(outputs)     # BCM pins clients may drive
+        self.segment = SamplerSegment(name, pins, size)
+        self._edges = {}
+        for pin in pins:
+            edges = self.segment.writer(pin)
+            backend.add_edge_detection(pin, edges, debounce)
+            # Level before the first edge, whatever came meanwhile
+            self.segment.set_level(pin, backend.input(pin) ^
+                                   bool(edges.count & 1))
+            self._edges[pin] = edges
+        self._socket_path = socket_path
+        self._listener = None
+        self._clients = {}      # socket -> (pending input, readers or None)
+        self._stop = threading.Event()
+
+    def run(self):
+        if self._socket_path:
+            if os.path.exists(self._socket_path):
+                os.unlink(self._socket_path)
+            self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._listener.bind(self._socket_path)
+            self._listener.listen(8)
+        self._logger.info("Sampling GPIO %s into '%s'" % (
+            ", ".join(str(pin) for pin in self._edges), self.segment.name))
+        while not self._stop.is_set():
+            self.segment.beat()
+            if self._listener is None:
+                self._stop.wait(POLL)
+                continue
+            sockets = [self._listener] + list(self._clients)
+            ready, _, _ = select.select(sockets, [], [], POLL)
+            for sock in ready:
+                if sock is self._listener:
+                    client, address = sock.accept()
+                    client.setblocking(False)
+                    self._clients[client] = [b"", None]
+                else:
+                    self._receive(sock)
+            self._stream()
+
+    def _receive(self, client):
+        try:
+            data = client.recv(4096)
+        except OSError:
+            data = b""
+        if not data:
+            self._drop(client)
+            return
+        state = self._clients[client]
+        lines = (state[0] + data).split(b"\n")
+        state[0] = lines.pop()
+        for line in lines:
+            try:
+                self._command(state, line.decode("ascii", "replace").split())
+            except Exception:
+                # One client must not stop the daemon of all the others
+                self._logger.exception("Command %r failed" % line)
+
+    def _command(self, state, words):
+        if words == ["watch"]:
+            state[1] = {pin: edges.reader()
+                        for pin, edges in self._edges.items()}
+        elif len(words) == 3 and words[0] == "output":
+            if not words[1].isdigit() or words[2] not in ("0", "1"):
+                self._logger.warning("Invalid command %r" % " ".join(words))
+            elif int(words[1]) not in self._outputs:
+                self._logger.warning("GPIO %s is not an output of the sampler"
+                                     % words[1])
+            else:
+                self._backend.output(int(words[1]), words[2] == "1")
+        elif words:
+            self._logger.warning("Unknown command %r" % " ".join(words))
+
+    def _stream(self):
+        for client, (pending, readers) in list(self._clients.items()):
+            if readers is None:
+                continue
+            lines = ["edge %i %.6f\n" % (pin, t)
+                     for pin, reader in readers.items()
+                     for t in reader.read()]
+            if not lines:
+                continue
+            try:
+                client.send("".join(lines).encode("ascii"))
+            except OSError:
+                # Slow or gone: a stream client must keep up
+                self._drop(client)
+
+    def _drop(self, client):
+        self._clients.pop(client, None)
+        client.close()
+
+    def stop(self):
+        self._stop.set()
+
+    def close(self):
+        for client in list(self._clients):
+            self._drop(client)
+        if self._listener is not None:
+            self._listener.close()
+            os.unlink(self._socket_path)
+        for pin in self._edges:
+            self._backend.remove_edge_detection(pin)
+        self._backend.close()
+        for edges in self._edges.values():
+            edges._times.release()
+        self.segment.close()
+        self.segment.unlink()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--pins", default="24",
+                        help="sensor pins, comma separated (default 24)")
+    parser.add_argument("--mode", choices=("bcm", "board"), default="bcm",
+                        help="pin numbering (default bcm)")
+    parser.add_argument("--backend", choices=("rpi", "gpiod", "mock"),
+                        default="gpiod", help="GPIO backend (default gpiod)")
+    parser.add_argument("--chip", default="/dev/gpiochip0",
+                        help="GPIO character device of the gpiod backend")
+    parser.add_argument("--debounce", type=float, default=0.0,
+                        help="debounce time in ms (default 0)")
+    parser.add_argument("--name", default=DEFAULT_NAME,
+                        help="shared memory segment (default %s)"
+                        % DEFAULT_NAME)
+    parser.add_argument("--size", type=int, default=4096,
+                        help="edges kept per pin, a power of two")
+    parser.add_argument("--socket", help="Unix socket for edge streams and "
+                                         "outputs")
+    parser.add_argument("--outputs", default="",
+                        help="output pins the socket clients may drive, "
+                             "comma separated (e.g. the bell)")
+    args = parser.parse_args(argv)
+    args.pins = [int(pin) for pin in args.pins.split(",") if pin]
+    args.outputs = [int(pin) for pin in args.outputs.split(",") if pin]
+    if set(args.pins) & set(args.outputs):
+        parser.error("a sensor pin cannot be an output")
+    if args.outputs and not args.socket:
+        parser.error("--outputs are driven through the --socket")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    logger = logging.getLogger("bovine_sampler")
+    pins, outputs = args.pins, args.outputs
+    if args.mode == "board":
+        # The segment always uses BCM numbers, whatever the readers use
+        pins = [BOARD_TO_BCM[pin] for pin in pins]
+        outputs = [BOARD_TO_BCM[pin] for pin in outputs]
+    backend = create_backend(args.backend, logger, chip=args.chip)
+    backend.set_mode(BCM)
+    sampler = Sampler(backend, pins, logger, args.name, args.size,
+                      args.debounce / 1000.0, args.socket, outputs)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sampler.stop())
+    try:
+        sampler.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sampler.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
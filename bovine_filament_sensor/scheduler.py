@@ -0,0 +1,137 @@
+import heapq
+import itertools
+import threading
+from .clock import MONOTONIC
+
+
+class Deadline:
+    """A re-armable deadline served by a DeadlineScheduler."""
+
+    __slots__ = ("callback", "when", "_seq", "_scheduler")
+
+    def __init__(self, scheduler, callback):
+        self.callback = callback
+        self.when = 0.0
+        self._seq = -1
+        self._scheduler = scheduler
+
+    def arm(self, delay):
+        """(Re)start the deadline to expire ``delay`` seconds from now."""
+        self._scheduler._arm(self, self._scheduler.clock.monotonic() + delay)
+
+    def cancel(self):
+        self._scheduler._cancel(self)
+
+
+class DeadlineScheduler(threading.Thread):
+    """Single long-lived thread firing deadlines kept in a heap.
+
+    The thread sleeps until the earliest deadline is due, so it does not
+    wake up at all while nothing is armed. Callbacks run on this thread
+    and must return quickly. With a virtual ``clock`` no thread is
+    started: the clock fires the deadlines as it advances.
+    """
+
+    def __init__(self, logger=None, name="BovineDeadlineScheduler",
+                 clock=MONOTONIC):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.clock = clock
+        self._logger = logger
+        self._cond = threading.Condition()
+        self._heap = []
+        self._counter = itertools.count()
+        self._stopped = False
+
+    def start(self):
+        if self.clock.virtual:
+            self.clock.attach(self)
+        else:
+            threading.Thread.start(self)
+
+    def deadline(self, callback):
+        """Return an unarmed deadline calling ``callback`` when it expires."""
+        return Deadline(self, callback)
+
+    def call_later(self, delay, callback):
+        """Run ``callback`` once after ``delay`` seconds."""
+        deadline = Deadline(self, callback)
+        deadline.arm(delay)
+        return deadline
+
+    def _arm(self, deadline, when):
+        with self._cond:
+            deadline.when = when
+            deadline._seq = next(self._counter)
+            heapq.heappush(self._heap, (when, deadline._seq, deadline))
+            if self._heap[0][2] is deadline:
+                self._cond.notify()
+
+    def _cancel(self, deadline):
+        # The heap entry is left in place and discarded when it comes up
+        with self._cond:
+            deadline._seq = -1
+
+    def run(self):
+        clock = self.clock
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    due, wait = self._take_due(clock.monotonic())
+                    if due:
+                        break
+                    self._cond.wait(wait)
+            self._fire(due)
+
+    def _take_due(self, now):
+        """Pop the deadlines due at ``now`` (lock held).
+
+        Returns them with the time until the next one, None if nothing
+        else is armed.
+        """
+        due = []
+        heap = self._heap
+        while heap:
+            when, seq, deadline = heap[0]
+            if seq != deadline._seq:
+                heapq.heappop(heap)     # cancelled or re-armed
+                continue
+            if when > now:
+                return due, when - now
+            heapq.heappop(heap)
+            deadline._seq = -1
+            due.append(deadline)
+        return due, None
+
+    def _fire(self, due):
+        for deadline in due:
+            try:
+                deadline.callback()
+            except Exception:
+                if self._logger is not None:
+                    self._logger.exception("Deadline callback failed")
+
+    def next_due(self):
+        """Time of the earliest armed deadline (VirtualClock driver)."""
+        with self._cond:
+            heap = self._heap
+            while heap and heap[0][1] != heap[0][2]._seq:
+                heapq.heappop(heap)
+            return heap[0][0] if heap else None
+
+    def run_due(self):
+        """Fire the deadlines due now (VirtualClock driver)."""
+        with self._cond:
+            due, wait = self._take_due(self.clock.monotonic())
+        self._fire(due)
+
+    def stop(self, timeout=1.0):
+        """Stop the thread and wait at most ``timeout`` seconds for it."""
+        with self._cond:
+            self._stopped = True
+            self._heap = []
+            self._cond.notify()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
@@ -0,0 +1,23 @@
+from .edge_buffer import EdgeBuffer
+
+
+class FilamentSensor:
+    """A filament sensor on one GPIO pin, watching the filament of one tool.
+
+    Only the sensor of the active tool is monitored. The distance engine
+    of the others is kept until their tool is selected again.
+    """
+
+    def __init__(self, tool, pin):
+        self.tool = tool
+        self.pin = pin
+        self.edges = EdgeBuffer()
+        self.distance_edges = self.edges.reader()
+        self.telemetry_edges = self.edges.reader()
+        self.health_edges = self.edges.reader()
+        self.flow = None
+        self.distance = None
+        self.health = None
+
+    def __repr__(self):
+        return "FilamentSensor(T%i, pin %i)" % (self.tool, self.pin)
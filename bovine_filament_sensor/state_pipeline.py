@@ -0,0 +1,194 @@
+import collections
+import json
+import threading
+import time
+from .clock import MONOTONIC
+
+
+class StatePipeline(threading.Thread):
+    """Single writer of the detection state.
+
+    Every change of the plugin and DetectionData state is a callable
+    submitted here and applied in order on this thread, so the state needs
+    no lock. ``submit`` is an append to a deque, a constant cost for the
+    printer communication thread. The worker wakes at most every
+    ``DRAIN_DELAY`` seconds, drains the changes queued meanwhile and then
+    publishes ``snapshot``, an immutable view of the state that any thread
+    can read. ``version`` is bumped whenever the snapshot changes.
+
+    ``status`` serves the snapshot as JSON, rendered once per version
+    whatever the number of readers, and ``wait`` blocks a reader until the
+    next version (long-poll). At most ``MAX_WAITERS`` readers wait at a
+    time, so they cannot hold all the web server threads.
+
+    With a virtual ``clock`` no thread is started: the clock drains the
+    queue ``DRAIN_DELAY`` after the first change, as the thread would.
+    """
+
+    DRAIN_DELAY = 0.01
+    MAX_WAITERS = 4
+
+    def __init__(self, logger, snapshot, name="BovineStatePipeline",
+                 clock=MONOTONIC):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.clock = clock
+        self._logger = logger
+        self._take_snapshot = snapshot
+        self._pending = collections.deque()
+        self._wake = threading.Event()
+        self._armed = False     # a wake up is pending
+        self._armed_at = 0.0
+        self._stopped = False
+        self.snapshot = None
+        self.version = 0
+        self._changed = threading.Condition()
+        self._waiters = 0
+        self._status = None     # (version, etag, body) last rendered
+        # Versions restart with OctoPrint, the ETags must not repeat
+        self._boot = "%x" % int(clock.time())
+
+    def submit(self, fn, *args):
+        """Queue ``fn(*args)`` to run on the pipeline (any thread)."""
+        self._pending.append((fn, args))
+        if not self._armed:
+            self._armed = True
+            if self.clock.virtual:
+                self._armed_at = self.clock.monotonic()
+            self._wake.set()
+
+    def call(self, fn, *args, timeout=10.0):
+        """Run ``fn(*args)`` on the pipeline, wait for it and return its result.
+
+        Runs it right away when called from the pipeline itself or before
+        the pipeline is started.
+        """
+        if threading.current_thread() is self or not self.is_alive():
+            return fn(*args)
+        done = threading.Event()
+        result = []
+
+        def run():
+            try:
+                result.append((True, fn(*args)))
+            except Exception as e:
+                result.append((False, e))
+            finally:
+                done.set()
+
+        self.submit(run)
+        if not done.wait(timeout):
+            raise TimeoutError("State pipeline did not run %s" % fn.__name__)
+        ok, value = result[0]
+        if not ok:
+            raise value
+        return value
+
+    def writer(self, target):
+        """Write-only view of ``target`` whose assignments are submitted."""
+        return StateWriter(self, target)
+
+    def pending(self):
+        return len(self._pending)
+
+    def start(self):
+        self._publish()
+        if self.clock.virtual:
+            self.clock.attach(self)
+        else:
+            threading.Thread.start(self)
+
+    def run(self):
+        while not self._stopped:
+            self._wake.wait()
+            self._wake.clear()
+            time.sleep(self.DRAIN_DELAY)    # let a batch build up
+            self.drain()
+
+    def drain(self):
+        """Apply the queued changes and publish the snapshot."""
+        pending = self._pending
+        self._armed = False
+        while pending:
+            fn, args = pending.popleft()
+            try:
+                fn(*args)
+            except Exception:
+                self._logger.exception("State change %s failed"
+                                       % getattr(fn, "__name__", fn))
+        self._publish()
+
+    def next_due(self):
+        """Time of the next drain (VirtualClock driver)."""
+        return self._armed_at + self.DRAIN_DELAY if self._pending else None
+
+    def run_due(self):
+        """Drain if due (VirtualClock driver)."""
+        if (self._pending and self.clock.monotonic() >=
+                self._armed_at + self.DRAIN_DELAY):
+            self.drain()
+
+    def _publish(self):
+        snapshot = self._take_snapshot()
+        if snapshot != self.snapshot:
+            with self._changed:
+                self.snapshot = snapshot
+                self.version += 1
+                self._changed.notify_all()
+
+    def status(self):
+        """``(version, etag, body)`` of the snapshot as JSON (any thread)."""
+        status = self._status
+        if status is None or status[0] != self.version:
+            with self._changed:
+                version, snapshot = self.version, self.snapshot
+            state = snapshot._asdict() if snapshot is not None else {}
+            state["version"] = version
+            status = self._status = (
+                version, '"%s-%i"' % (self._boot, version),
+                json.dumps(state, separators=(",", ":")))
+        return status
+
+    def wait(self, version, timeout):
+        """Wait up to ``timeout`` seconds for a version other than
+        ``version`` and return the current one (any other thread).
+
+        Returns right away with a virtual clock, on the pipeline itself or
+        when ``MAX_WAITERS`` readers are already waiting.
+        """
+        if self.clock.virtual or threading.current_thread() is self:
+            return self.version
+        with self._changed:
+            if self._waiters >= self.MAX_WAITERS:
+                return self.version
+            self._waiters += 1
+            try:
+                self._changed.wait_for(
+                    lambda: self.version != version or self._stopped, timeout)
+            finally:
+                self._waiters -= 1
+            return self.version
+
+    def stop(self, timeout=1.0):
+        """Apply the changes still queued and stop the thread."""
+        self._stopped = True
+        self._wake.set()
+        with self._changed:
+            self._changed.notify_all()
+        if self.is_alive():
+            self.join(timeout)
+        else:
+            self.drain()
+
+
+class StateWriter:
+    """Assignments to this object are applied to the target by a pipeline."""
+
+    __slots__ = ("_pipeline", "_target")
+
+    def __init__(self, pipeline, target):
+        object.__setattr__(self, "_pipeline", pipeline)
+        object.__setattr__(self, "_target", target)
+
+    def __setattr__(self, name, value):
+        self._pipeline.submit(setattr, self._target, name, value)
@@ -16,6 +16,7 @@ $(function() {
         self.lastMotionDetected = ko.observable(undefined);
         self.isFilamentMoving = ko.observable(undefined);
         self.isConnectionTestRunning = ko.observable(false);
+        self.calibrationResult = ko.observable("");
 
         self.onStartup = function() {
             self.connectionTestDialog = $("#settings_plugin_bovine_filament_sensor_connectiontest");
@@ -32,19 +33,48 @@ $(function() {
                 return;
             }
             
-            var message = JSON.parse(data);
-            self.remainingDistance(message["_remaining_distance"]);
-            self.lastMotionDetected(message["_last_motion_detected"]);
-            self.isConnectionTestRunning(message["_connection_test_running"]);
-
-            if(message["_filament_moving"] == true){
-                self.isFilamentMoving("Movement detected");
+            // Messages only carry the fields that changed since the last one
+            if("remaining_distance" in data){
+                self.remainingDistance(data["remaining_distance"]);
+            }
+            if("last_motion_detected" in data){
+                self.lastMotionDetected(data["last_motion_detected"]);
+            }
+            if("connection_test_running" in data){
+                self.isConnectionTestRunning(data["connection_test_running"]);
+            }
+            if("calibration" in data){
+                var result = data["calibration"];
+                if(result["pulses"] > 0){
+                    var settings = self.settingsViewModel.settings.plugins.bovine_filament_sensor;
+                    settings.mm_per_pulse(result["mm_per_pulse"]);
+                    settings.pulse_counting(true);
+                    self.calibrationResult(result["pulses"] + " edges for " + result["length"] + " mm: " + result["mm_per_pulse"] + " mm per pulse");
+                }
+                else{
+                    self.calibrationResult("No sensor edge during the extrusion");
+                }
             }
-            else{
-                self.isFilamentMoving("Filament is not moving");
+            if("filament_moving" in data){
+                if(data["filament_moving"] == true){
+                    self.isFilamentMoving("Movement detected");
+                }
+                else{
+                    self.isFilamentMoving("Filament is not moving");
+                }
             }
         };
 
+        // Sensors of the tools other than T0
+        self.addExtraSensor = function() {
+            var sensors = self.settingsViewModel.settings.plugins.bovine_filament_sensor.extra_sensors;
+            sensors.push({tool: ko.observable(sensors().length + 1), pin: ko.observable("")});
+        };
+
+        self.removeExtraSensor = function(sensor) {
+            self.settingsViewModel.settings.plugins.bovine_filament_sensor.extra_sensors.remove(sensor);
+        };
+
         self.enableConnectionTest = ko.pureComputed(function() {
             return !self.printerStateViewModel.isBusy();
         });
@@ -71,6 +101,24 @@ $(function() {
             });
         };
 
+        self.calibrate = function(){
+            self.calibrationResult("Extruding...");
+            $.ajax({
+                url: API_BASEURL + "plugin/bovine_filament_sensor",
+                type: "POST",
+                dataType: "json",
+                data: JSON.stringify({
+                    "command": "calibrate",
+                    "length": self.settingsViewModel.settings.plugins.bovine_filament_sensor.calibration_length()
+                }),
+                contentType: "application/json",
+                success: self.RestSuccess,
+                error: function(xhr){
+                    self.calibrationResult(xhr.responseText);
+                }
+            });
+        };
+
         self.RestSuccess = function(response){
             return;
         }
@@ -9,6 +9,9 @@ $(function(){
         self.lastMotionDetected = ko.observable(undefined);
         self.isFilamentMoving = ko.observable(undefined);
         self.isConnectionTestRunning = ko.observable(false);
+        self.activeTool = ko.observable("T0");
+        self.isLoadReduced = ko.observable(false);
+        self.healthWarnings = ko.observableArray([]);
 
         //Returns the value of sensor_enabled as Yes/No
         self.getSensorEnabledString = function(){
@@ -32,17 +35,23 @@ $(function(){
             else if(detectionMethod == 1){
                 return "Distance";
             }
+            else if(detectionMethod == 2){
+                return "Fused";
+            }
         };
 
+        // True when the distance detection runs (distance or fused)
         self.getDetectionMethodBoolean = ko.pureComputed(function(){
             var detectionMethod = self.settingsViewModel.settings.plugins.bovine_filament_sensor.detection_method();
 
-            if(detectionMethod == 0){
-                return false;
-            }
-            else if(detectionMethod == 1){
-                return true;
-            }
+            return detectionMethod == 1 || detectionMethod == 2;
+        });
+
+        // True when the timeout detection runs (timeout or fused)
+        self.isTimeoutDetection = ko.pureComputed(function(){
+            var detectionMethod = self.settingsViewModel.settings.plugins.bovine_filament_sensor.detection_method();
+
+            return detectionMethod == 0 || detectionMethod == 2;
         });
 
         self.onDataUpdaterPluginMessage = function(plugin, data){
@@ -50,22 +59,48 @@ $(function(){
                 return;
             }
             
-            var message = JSON.parse(data);
-            self.remainingDistance( Math.round(message["_remaining_distance"]) );
-            self.lastMotionDetected((new Date((message["_last_motion_detected"] * 1000))).toLocaleString());
+            // Messages only carry the fields that changed since the last one
+            if("remaining_distance" in data){
+                self.remainingDistance(Math.round(data["remaining_distance"]));
+            }
+            if("last_motion_detected" in data){
+                self.lastMotionDetected((new Date((data["last_motion_detected"] * 1000))).toLocaleString());
+            }
 
-            if(message["_filament_moving"] == true){
-                self.isFilamentMoving("Yes");
+            if("hook_degraded" in data){
+                self.isLoadReduced(data["hook_degraded"] == true);
             }
-            else{
-                self.isFilamentMoving("No");
+
+            if("health" in data){
+                var warnings = [];
+                $.each(data["health"], function(tool, found){
+                    $.each(found, function(i, warning){
+                        warnings.push(tool + ": " + warning);
+                    });
+                });
+                self.healthWarnings(warnings);
             }
 
-            if(message["_connection_test_running"] == true){
-                self.isConnectionTestRunning("Running");
+            if("active_tool" in data){
+                self.activeTool("T" + data["active_tool"]);
             }
-            else{
-                self.isConnectionTestRunning("Stopped");
+
+            if("filament_moving" in data){
+                if(data["filament_moving"] == true){
+                    self.isFilamentMoving("Yes");
+                }
+                else{
+                    self.isFilamentMoving("No");
+                }
+            }
+
+            if("connection_test_running" in data){
+                if(data["connection_test_running"] == true){
+                    self.isConnectionTestRunning("Running");
+                }
+                else{
+                    self.isConnectionTestRunning("Stopped");
+                }
             }
         };
 
@@ -0,0 +1,126 @@
+"""Memory-mapped ring file of what the detectors saw and decided.
+
+Entries have a fixed width of 16 bytes (``ENTRY``): wall time, kind, an
+argument (tool or reason) and a value. They are written with
+``pack_into`` straight into the mapping, so recording costs about as much
+as a dict lookup and survives a crash of OctoPrint.
+
+Sampled kinds (edges, E positions, remaining distance, extruded filament)
+are decimated by ``step``. Each time the ring wraps in less than ``keep``
+seconds the step is doubled, so long jobs keep a coarser but longer
+history. Decisions are always recorded.
+"""
+import itertools
+import mmap
+import os
+import struct
+from .clock import MONOTONIC
+
+ENTRY = struct.Struct("<dHhf")     # time, kind, arg, value
+HEADER = struct.Struct("<8sQQ")    # magic, capacity, entries written
+MAGIC = b"BFSTEL01"
+
+# Kinds
+EDGE = 1            # arg: tool, value: edges represented
+E_POSITION = 2      # arg: tool, value: E word of a move
+REMAINING = 3       # arg: tool, value: remaining distance (mm)
+PAUSE = 4           # arg: reason, value: 1 if dispatched, 0 if already sent
+PAUSE_IGNORED = 5   # arg: reason, value: seconds since the last movement
+RESUME = 6          # arg: reason, response cancelled by new motion
+JOB_START = 7       # arg: first tool
+EXTRUDED = 8        # arg: tool, value: filament commanded so far (mm)
+
+# Reasons of a decision
+TIMEOUT = 1
+DISTANCE = 2
+FLOW = 3
+
+SAMPLED = frozenset((EDGE, E_POSITION, REMAINING, EXTRUDED))
+
+
+class TelemetryRing:
+    MAX_STEP = 64
+
+    def __init__(self, path, capacity=65536, keep=3600.0, clock=MONOTONIC):
+        self.path = path
+        self._clock = clock
+        self.capacity = capacity
+        self.keep = keep
+        size = HEADER.size + capacity * ENTRY.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            reuse = os.fstat(fd).st_size == size
+            if not reuse:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, stored, written = HEADER.unpack_from(self._map, 0)
+        if not reuse or magic != MAGIC or stored != capacity:
+            written = 0
+        # Continue after the entries of the previous run
+        self._counter = itertools.count(written)
+        self._written = written
+        self._offset = clock.time() - clock.monotonic()
+        self.step = 1
+        self._skipped = {}
+        self._lap_start = clock.monotonic()
+
+    def record(self, kind, arg, value, when=None):
+        """Append an entry. ``when`` is a monotonic time, default now."""
+        if kind in SAMPLED and self.step > 1:
+            skipped = self._skipped.get(kind, 0) + 1
+            if skipped < self.step:
+                self._skipped[kind] = skipped
+                return
+            self._skipped[kind] = 0
+        if when is None:
+            when = self._clock.monotonic()
+        self._write(when, kind, arg, value)
+
+    def record_edges(self, tool, edges):
+        """Record a batch of edge timestamps of the sensor of ``tool``."""
+        step = self.step
+        if step > 1:
+            edges = edges[step - 1::step]
+        for when in edges:
+            self._write(when, EDGE, tool, step)
+
+    def _write(self, when, kind, arg, value):
+        n = next(self._counter)
+        slot = n % self.capacity
+        ENTRY.pack_into(self._map, HEADER.size + slot * ENTRY.size,
+                        when + self._offset, kind, arg, value)
+        self._written = n + 1
+        HEADER.pack_into(self._map, 0, MAGIC, self.capacity, n + 1)
+        if slot == self.capacity - 1:
+            self._wrapped(when)
+
+    def _wrapped(self, now):
+        """Downsample when the ring holds less than ``keep`` seconds."""
+        if now - self._lap_start < self.keep and self.step < self.MAX_STEP:
+            self.step *= 2
+        self._lap_start = now
+
+    def reset_step(self):
+        """Record at full resolution again (new job)."""
+        self.step = 1
+        self._skipped.clear()
+        self._lap_start = self._clock.monotonic()
+
+    def sync_clock(self):
+        """Follow wall clock adjustments (NTP) in the recorded times."""
+        self._offset = self._clock.time() - self._clock.monotonic()
+
+    def entries(self, start, end):
+        """Packed entries with a wall time in [start, end], oldest first."""
+        data = self._map[HEADER.size:]
+        # Unused slots have a time of 0
+        selected = [entry for entry in ENTRY.iter_unpack(data)
+                    if start <= entry[0] <= end]
+        selected.sort(key=lambda entry: entry[0])
+        return b"".join(ENTRY.pack(*entry) for entry in selected)
+
+    def close(self):
+        self._map.flush()
+        self._map.close()
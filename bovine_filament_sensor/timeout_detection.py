@@ -1,49 +1,108 @@
-import RPi.GPIO as GPIO
-import threading
-import time
-
-class TimeoutDetector(threading.Thread):
-    def __init__(self, thread_id, thread_name, pin,
-                 max_idle_time, logger, data, callback=None):
-        """Initialize Filament TimeoutDetector"""
-        threading.Thread.__init__(self)
-        self.thread_id = thread_id
-        self.name = thread_name
+class TimeoutDetector:
+    # Seconds between two reads of the edge buffer while the filament
+    # stands still, to report when it moves again
+    RESUME_INTERVAL = 1.0
+
+    def __init__(self, name, edges, max_idle_time, logger, data,
+                 scheduler, callback=None, quiet=None, jitter=None,
+                 adaptive=None):
+        """Initialize Filament TimeoutDetector.
+
+        Sensor edges are read in batches from the EdgeBuffer by a deadline
+        in the shared scheduler, armed for when the timeout can expire
+        counting from the last edge. ``callback(False)`` is called when no edge
+        arrived during max_idle_time and ``callback(True)`` when motion
+        resumes afterwards. ``quiet(idle)`` returns the time left in a
+        planned pause of the job: the idle time then counts from the end
+        of the pause.
+        ``jitter`` is an optional histogram of the lateness of the checks.
+        With an AdaptiveTimeout ``adaptive`` the timeout follows the
+        extrusion rate, max_idle_time being the ceiling.
+        """
+        self.name = name
         self.callback = callback
+        self.quiet = quiet
+        self._jitter = jitter
+        self.adaptive = adaptive
         self._logger = logger
         self._data = data
-        self.used_pin = pin
+        self._edges = edges.reader()
+        self._clock = scheduler.clock
         self.max_idle_time = max_idle_time
-        self._data.last_motion_detected = time.time()
-        self.keep_running = True
-
-        # Remove event, if already an event was set
-        try:
-            GPIO.remove_event_detect(pin)
-        except ValueError:
-            self._logger.warn("Pin %s not used before" % pin)
-            
-        GPIO.add_event_detect(pin, GPIO.BOTH, callback=self.motion)
-
-    def run(self):
-        """Override run method of threading.Thread"""
-        while self.keep_running:
-            timespan = (time.time() - self._data.last_motion_detected)
-
-            if timespan > self.max_idle_time:
-                if self.callback is not None:
-                    self.callback()
-
-            time.sleep(0.250)
-
-        GPIO.remove_event_detect(self.used_pin)
-
-    # noinspection PyUnusedLocal
-    def motion(self, pin):
-        """Eventhandler for GPIO filament sensor signal.
-        The new state of the GPIO pin is read and timed.
-        """
-        last_motion = time.time()
-        self._data.last_motion_detected = last_motion
-        self.callback(True)
-        self._logger.debug("Motion detected at %s" % last_motion)
+        self.is_moving = True
+        self.last_motion = None
+        self._pause_end = None     # end of the last planned pause
+        self._paused = False
+        self._deadline = scheduler.deadline(self.check)
+
+    def start(self):
+        """Arm the idle deadline."""
+        self.is_moving = True
+        self._edges.skip()
+        self.last_motion = self._clock.monotonic()
+        self._pause_end = None
+        self._paused = False
+        self._data.last_motion_detected = self._clock.time()
+        self._deadline.arm(self._delay(0.0))
+
+    def stop(self):
+        """Cancel the deadline."""
+        self._deadline.cancel()
+
+    def check(self):
+        """Consume the new edges and fire on timeout (scheduler thread)."""
+        edges = self._edges.read()
+        now = self._clock.monotonic()
+        if self._jitter is not None:
+            self._jitter.observe(now - self._deadline.when)
+        if edges:
+            self.motion(edges[-1], now)
+        delay = self._delay(self._idle(now))
+        if ((delay <= 0 or self._paused) and self.is_moving
+                and self.quiet is not None):
+            # Ask again at the end of the excused time, the pause may last
+            quiet = self.quiet(now - self.last_motion)
+            self._paused = quiet > 0
+            if self._paused:
+                self._logger.debug("No motion during a planned pause")
+                delay = min(quiet, self.max_idle_time)
+                self._pause_end = now + delay
+        if delay <= 0 and self.is_moving:
+            self.is_moving = False
+            if self.callback is not None:
+                self.callback(False)
+        self._deadline.arm(delay if self.is_moving else self.RESUME_INTERVAL)
+
+    def reschedule(self):
+        """Check again when the timeout can expire, after a change of
+        max_idle_time or of the adaptive timeout."""
+        if self.is_moving:
+            idle = self._idle(self._clock.monotonic())
+            self._deadline.arm(max(self._delay(idle), 0.0))
+
+    def _idle(self, now):
+        """Seconds without motion outside of the planned pauses."""
+        if self._pause_end is None or self._pause_end < self.last_motion:
+            return now - self.last_motion
+        return max(now - self._pause_end, 0.0)
+
+    def _delay(self, idle):
+        """Seconds until the timeout can expire, ``idle`` seconds after the
+        last edge."""
+        delay = self.max_idle_time - idle
+        if delay > 0 and self.adaptive is not None:
+            delay = min(delay, self.adaptive.due(idle) - idle)
+        return delay
+
+    def motion(self, last_edge, now):
+        """Register the latest edge of a batch."""
+        self.last_motion = last_edge
+        if self.adaptive is not None:
+            self.adaptive.motion()
+        wall_time = self._clock.time() - (now - last_edge)
+        self._data.last_motion_detected = wall_time
+        if not self.is_moving:
+            self.is_moving = True
+            if self.callback is not None:
+                self.callback(True)
+        self._logger.debug("Motion detected at %s", wall_time)
@@ -0,0 +1,83 @@
+import threading
+
+
+class UIPublisher:
+    """Coalesce DetectionData changes into rate-limited plugin messages.
+
+    Setters only mark a field as changed. The changed fields are sent as a
+    plain dict at most ``max_rate`` times per second, and nothing is done
+    at all while no client is connected.
+    """
+
+    def __init__(self, send, scheduler, max_rate=5):
+        self._send = send
+        self._scheduler = scheduler
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._timer = None
+        self._last_flush = 0.0
+        self._min_interval = 0.0
+        self.clients = 0
+        self.suspended = False
+        self.max_rate = max_rate
+
+    @property
+    def max_rate(self):
+        return 1.0 / self._min_interval if self._min_interval else 0
+
+    @max_rate.setter
+    def max_rate(self, value):
+        value = float(value)
+        self._min_interval = 1.0 / value if value > 0 else 0.0
+
+    def publish(self, key, value):
+        """Mark a field as changed and schedule a flush if none is pending."""
+        if self.clients <= 0:
+            return
+        with self._lock:
+            self._pending[key] = value
+            if self.suspended:
+                # Only remembered, publish_all sends the state on resume
+                return
+            if self._timer is None:
+                delay = self._last_flush + self._min_interval - self._scheduler.clock.monotonic()
+                self._timer = self._scheduler.call_later(max(delay, 0.0),
+                                                         self.flush)
+
+    def publish_all(self, values):
+        """Send a full snapshot right away (e.g. to a freshly logged in client)."""
+        with self._lock:
+            self._pending.clear()
+            self._last_flush = self._scheduler.clock.monotonic()
+        self._send(dict(values))
+
+    def flush(self):
+        """Send the fields changed since the last flush."""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._timer = None
+            self._last_flush = self._scheduler.clock.monotonic()
+        if pending and self.clients > 0:
+            self._send(pending)
+
+    def suspend(self):
+        """Hold the changes back, e.g. while the plugin is under load."""
+        self.suspended = True
+
+    def resume(self):
+        self.suspended = False
+
+    def client_opened(self):
+        self.clients += 1
+
+    def client_closed(self):
+        self.clients = max(self.clients - 1, 0)
+
+    def cancel(self):
+        """Drop pending changes and stop the flush timer."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._pending.clear()
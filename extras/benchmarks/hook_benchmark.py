@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+"""Microbenchmark of the ``distance_detection`` G-code sent hook.
+
+Pushes every line of a G-code file through the hook of a plugin instance
+configured for distance detection and reports the cost in ns/line, for the
+interpretation of the lines alone and for the hook along with the state
+pipeline that applies the lines it queues.
+Without a file argument a synthetic print of ``--lines`` lines is generated.
+
+    $ python3 extras/benchmarks/hook_benchmark.py [file.gcode] [--lines N]
+
+Run it from a virtualenv where OctoPrint is installed.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from replay import SENSOR_PIN, make_plugin, read_commands
+from bovine_filament_sensor.gcode import extract_e
+
+
+def write_synthetic_gcode(path, lines):
+    """Write a print with a typical mix of extruding, travel and other lines."""
+    rnd = random.Random(0)
+    e = 0.0
+    with open(path, "w") as f:
+        f.write("M82\nG92 E0\n")
+        for n in range(lines):
+            r = rnd.random()
+            x, y = rnd.uniform(0, 200), rnd.uniform(0, 200)
+            if r < 0.80:
+                e += rnd.uniform(0.01, 0.5)
+                f.write("G1 X%.3f Y%.3f E%.5f\n" % (x, y, e))
+            elif r < 0.95:
+                f.write("G0 F9000 X%.3f Y%.3f\n" % (x, y))
+            elif r < 0.99:
+                f.write("M204 S1000\n")
+            else:
+                f.write("G1 Z%.2f\n" % (n / lines * 100))
+
+
+def bench(label, func, commands, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        func(commands)
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("%-28s %8.1f ns/line  (%d lines, best of %d)"
+          % (label, best / len(commands), len(commands), repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("gcode", nargs="?", help="G-code file to replay")
+    parser.add_argument("--lines", type=int, default=2000000,
+                        help="lines of the synthetic print (default 2000000)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--edge-every", type=int, default=20,
+                        help="simulate a sensor edge every N lines")
+    args = parser.parse_args()
+
+    path = args.gcode
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix=".gcode")
+        os.close(fd)
+        write_synthetic_gcode(path, args.lines)
+    try:
+        commands = read_commands(path)
+    finally:
+        if args.gcode is None:
+            os.remove(path)
+
+    plugin = make_plugin(detection_method=1)
+    plugin.init_distance_detection()
+    hook = plugin.distance_detection
+    interpret = plugin._interpret
+    pipeline = plugin._pipeline
+    emit = plugin._gpio.emit
+    every = args.edge_every
+
+    def run_empty(cmds):
+        for cmd, gcode in cmds:
+            pass
+
+    def run_extract(cmds):
+        for cmd, gcode in cmds:
+            extract_e(cmd)
+
+    def run_interpret(cmds):
+        for n, (cmd, gcode) in enumerate(cmds):
+            interpret(cmd, gcode)
+            if n % every == 0:
+                emit(SENSOR_PIN)
+
+    def run_hook(cmds):
+        for n, (cmd, gcode) in enumerate(cmds):
+            hook(None, "sent", cmd, None, gcode)
+            if n % every == 0:
+                emit(SENSOR_PIN)
+        # Until the pipeline has applied every line
+        pipeline.call(lambda: None)
+
+    bench("loop overhead", run_empty, commands, args.repeat)
+    bench("extract_e", run_extract, commands, args.repeat)
+    bench("interpretation", run_interpret, commands, args.repeat)
+    bench("distance_detection+pipeline", run_hook, commands, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
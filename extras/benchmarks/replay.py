@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+"""Offline replay and benchmark harness for the plugin.
+
+Drives BovineFilamentSensorPlugin without a Raspberry Pi: sensor edges go
+through the in-process ``mock`` GPIO backend and G-code lines through the
+``distance_detection`` hook, along with the OctoPrint events a print
+produces. Reports:
+
+- hook throughput (lines/s) while replaying a G-code file
+- edge throughput and CPU per edge at fixed edge rates
+- UI messages and bytes per second
+- jam-to-pause latency of the timeout detection
+- with ``--simulate``, a long print replayed in virtual time with a jam
+  near its end, and the exact jam-to-pause latency
+
+    $ python3 extras/benchmarks/replay.py [--gcode file.gcode] [--edges capture.txt]
+    $ python3 extras/benchmarks/replay.py --simulate 10 --jam-at 9
+
+Edge captures are text files with one edge time (seconds) per line.
+Run it from a virtualenv where OctoPrint is installed.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from octoprint.events import Events  # noqa: E402
+from bovine_filament_sensor import BovineFilamentSensorPlugin  # noqa: E402
+from bovine_filament_sensor.clock import MONOTONIC, VirtualClock  # noqa: E402
+
+SENSOR_PIN = 24
+
+DEFAULT_SETTINGS = dict(
+    gpio_backend="mock", gpio_chip="/dev/gpiochip0",
+    sampler_segment="bovine_sampler", sampler_socket="", mode=1,
+    sensor_enabled=True, sensor_pin=SENSOR_PIN, extra_sensors=[],
+    debounce_time=0,
+    detection_method=1, fusion_votes=2,
+    z_events_number=0, detection_distance=15, max_idle_time=45,
+    adaptive_timeout=False, adaptive_pulses=5, min_idle_time=5,
+    pause_command="M600", alarm_pin=21, alarm_url="", ui_max_rate=5,
+    flow_detection=False, mm_per_pulse=1.0, flow_window=10,
+    flow_min_ratio=0.5, pulse_counting=False, calibration_length=100,
+    calibration_feedrate=100, gcode_index=False, hook_budget=20,
+)
+
+
+class Settings:
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, path):
+        return self.values[path[0]]
+
+    def get_boolean(self, path):
+        return bool(self.values[path[0]])
+
+    def set(self, path, value):
+        self.values[path[0]] = value
+
+    def save(self):
+        pass
+
+
+class PluginManager:
+    """Counts the plugin messages sent to the UI."""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def send_plugin_message(self, identifier, message):
+        self.messages += 1
+        self.bytes += len(json.dumps(message))
+
+
+class Printer:
+    """Records the commands sent to the printer with their time."""
+
+    def __init__(self, clock=MONOTONIC):
+        self.clock = clock
+        self.sent = []
+        self.event = threading.Event()
+
+    def commands(self, commands):
+        self.sent.append((self.clock.monotonic(), commands))
+        self.event.set()
+
+
+def make_plugin(debug=False, clock=MONOTONIC, **settings):
+    values = dict(DEFAULT_SETTINGS)
+    values.update(settings)
+    plugin = BovineFilamentSensorPlugin()
+    plugin._clock = clock
+    plugin._settings = Settings(values)
+    plugin._logger = logging.getLogger("replay")
+    plugin._logger.setLevel(logging.DEBUG if debug else logging.WARNING)
+    plugin._plugin_manager = PluginManager()
+    plugin._printer = Printer(clock)
+    plugin._identifier = "bovine_filament_sensor"
+    plugin._data_folder = tempfile.mkdtemp(prefix="bovine_replay_")
+    plugin.initialize()
+    plugin.on_after_startup()
+    return plugin
+
+
+def start_print(plugin):
+    """Send the events of a print start until the sensor is running."""
+    plugin.on_event(Events.PRINT_STARTED, {})
+    for n in range(plugin.z_event_number + 1):
+        plugin.on_event(Events.Z_CHANGE, {})
+    # Events are applied by the state pipeline
+    if plugin._clock.virtual:
+        plugin._clock.advance(plugin._pipeline.DRAIN_DELAY)
+    else:
+        plugin._pipeline.call(lambda: None)
+
+
+def read_commands(path):
+    """Return (cmd, gcode) pairs as OctoPrint hands them to the hook."""
+    commands = []
+    with open(path) as f:
+        for line in f:
+            cmd = line.split(";", 1)[0].strip()
+            if cmd:
+                commands.append((cmd, cmd.split(" ", 1)[0]))
+    return commands
+
+
+def read_edges(path):
+    """Return the edge times of a capture, relative to the first edge."""
+    with open(path) as f:
+        times = [float(line) for line in f if line.strip()
+                 and not line.startswith("#")]
+    return [t - times[0] for t in times] if times else []
+
+
+def emit_edges(plugin, times, stop=None):
+    """Emit sensor edges at the given times (seconds from now)."""
+    emit = plugin._gpio.emit
+    start = time.monotonic()
+    for t in times:
+        if stop is not None and stop.is_set():
+            break
+        delay = start + t - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        emit(SENSOR_PIN)
+
+
+def bench_hook(commands, edge_every=20):
+    plugin = make_plugin(detection_method=1)
+    start_print(plugin)
+    hook = plugin.distance_detection
+    emit = plugin._gpio.emit
+    start = time.perf_counter()
+    for n, (cmd, gcode) in enumerate(commands):
+        hook(None, "sent", cmd, None, gcode)
+        if n % edge_every == 0:
+            emit(SENSOR_PIN)
+    plugin._pipeline.call(lambda: None)
+    elapsed = time.perf_counter() - start
+    plugin.on_shutdown()
+    print("hook: %d lines in %.2f s, %.0f lines/s, %.0f ns/line"
+          % (len(commands), elapsed, len(commands) / elapsed,
+             elapsed * 1e9 / len(commands)))
+
+
+def bench_edges(rate, duration, times=None):
+    plugin = make_plugin(detection_method=0)
+    plugin._publisher.client_opened()
+    start_print(plugin)
+    if times is None:
+        times = [n / rate for n in range(int(rate * duration))]
+    manager = plugin._plugin_manager
+    cpu = time.process_time()
+    thread_cpu = time.thread_time()
+    start = time.monotonic()
+    emit_edges(plugin, times)
+    elapsed = time.monotonic() - start
+    thread_cpu = time.thread_time() - thread_cpu
+    cpu = time.process_time() - cpu
+    dropped = plugin._sensor.edges.dropped
+    plugin.on_shutdown()
+    print("edges @ %5.0f Hz: %d edges, callback %.2f us/edge, process "
+          "%.2f us/edge (%.1f%% CPU), %d dropped, UI %.1f msg/s %.0f B/s"
+          % (len(times) / elapsed if elapsed else 0, len(times),
+             thread_cpu * 1e6 / len(times), cpu * 1e6 / len(times),
+             cpu * 100 / elapsed, dropped,
+             manager.messages / elapsed, manager.bytes / elapsed))
+
+
+def bench_latency(max_idle_time, rate=20, moving=2.0):
+    plugin = make_plugin(detection_method=0, max_idle_time=max_idle_time)
+    start_print(plugin)
+    printer = plugin._printer
+    emit_edges(plugin, [n / rate for n in range(int(rate * moving))])
+    jam = time.monotonic()
+    printer.event.wait(max_idle_time * 2 + 5)
+    plugin.on_shutdown()
+    if not printer.sent:
+        print("latency: no pause sent")
+        return
+    latency = printer.sent[0][0] - jam
+    print("latency: jam to pause %.1f ms (max_idle_time %s s, overshoot "
+          "%.1f ms)" % (latency * 1e3, max_idle_time,
+                        (latency - max_idle_time) * 1e3))
+
+
+def simulate_jam(hours, jam_at, max_idle_time=45, rate=5.0, lines=20.0,
+                 method=0, votes=2):
+    """Replay a print of ``hours`` in virtual time, jammed at ``jam_at``.
+
+    The sensor gives ``rate`` edges/s and ``lines`` G-code lines/s go
+    through the hook until the jam. Returns the jam-to-pause latency.
+    """
+    clock = VirtualClock()
+    plugin = make_plugin(clock=clock, detection_method=method,
+                         fusion_votes=votes, max_idle_time=max_idle_time,
+                         adaptive_timeout=True, mm_per_pulse=1.0)
+    start_print(plugin)
+    hook = plugin.distance_detection
+    emit = plugin._gpio.emit
+    printer = plugin._printer
+    step = 1.0 / rate
+    per_step = max(int(lines / rate), 1)
+    line = "G1 X10 Y10 E%g" % (1.0 / per_step)
+    hook(None, "sent", "M83", None, "M83")
+    start = time.perf_counter()
+    jam = plugin._clock.monotonic() + jam_at * 3600
+    end = plugin._clock.monotonic() + hours * 3600
+    last_edge = None
+    while clock.monotonic() < end and not printer.sent:
+        if clock.monotonic() < jam:
+            emit(SENSOR_PIN)
+            last_edge = clock.monotonic()
+        for n in range(per_step):
+            hook(None, "sent", line, None, "G1")
+        clock.advance(step)
+    elapsed = time.perf_counter() - start
+    plugin.on_shutdown()
+    if not printer.sent:
+        print("simulation: no pause sent")
+        return None
+    latency = printer.sent[0][0] - last_edge
+    print("simulation: %.1f h of print in %.1f s, jam at %.2f h paused "
+          "after %.3f s (virtual)" % (printer.sent[0][0] / 3600, elapsed,
+                                      jam_at, latency))
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--gcode", help="G-code file pushed through the hook")
+    parser.add_argument("--edges", help="edge capture replayed in real time")
+    parser.add_argument("--rates", default="1000,2000,5000,10000",
+                        help="synthetic edge rates in Hz (comma separated)")
+    parser.add_argument("--duration", type=float, default=2.0,
+                        help="seconds per edge rate")
+    parser.add_argument("--max-idle-time", type=float, default=1.0)
+    parser.add_argument("--simulate", type=float, metavar="HOURS",
+                        help="only replay a print of HOURS in virtual time")
+    parser.add_argument("--jam-at", type=float, metavar="HOURS",
+                        help="time of the jam in the simulated print")
+    parser.add_argument("--method", type=int, choices=(0, 1, 2), default=0,
+                        help="detection method of the simulated print: "
+                             "timeout, distance or fused (default 0)")
+    parser.add_argument("--votes", type=int, default=2,
+                        help="engines that must agree with --method 2")
+    args = parser.parse_args()
+
+    if args.simulate:
+        simulate_jam(args.simulate, args.jam_at if args.jam_at is not None
+                     else args.simulate * 0.9, method=args.method,
+                     votes=args.votes)
+        return
+
+    if args.gcode:
+        bench_hook(read_commands(args.gcode))
+    if args.edges:
+        bench_edges(None, None, read_edges(args.edges))
+    for rate in args.rates.split(","):
+        if rate:
+            bench_edges(float(rate), args.duration)
+    bench_latency(args.max_idle_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+#!/usr/bin/python3
+"""Offline auto-tuner for max_idle_time and detection_distance.
+
+Loads the telemetry of many recorded jobs (``telemetry.ring`` files or
+``getTelemetry`` dumps, see the README) and computes over the whole
+history, with NumPy and without a Python loop over the edges:
+
+- the gaps between sensor edges, conditioned on the extrusion rate
+- the longest legitimate quiet window of each job
+- the filament commanded between two edges, and the edges per mm
+
+Gaps that contain a pause decision of the plugin (a jam, or a false
+pause) are not legitimate and left out. The recommended thresholds are
+the smallest ones that would have falsely paused at most
+``--false-pause-rate`` of the jobs, times ``--margin``: the lowest
+detection latency for that rate.
+
+    $ python3 extras/tuning/autotune.py ~/telemetry/*.bin --false-pause-rate 0.01
+
+The files of a directory are the history of one printer: keep the
+copies of each ring in a directory of their own, so that the jobs of two
+printers recorded at the same time do not mix.
+
+The filament commanded is recorded while the distance or the flow rate
+detection (or the adaptive timeout) is enabled, otherwise only
+max_idle_time is tuned. Downsampled history gives conservative values.
+"""
+import argparse
+import os
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    sys.exit("The auto-tuner needs NumPy: pip install numpy")
+
+# The telemetry module does not need OctoPrint, load it without running
+# the package __init__
+import types  # noqa: E402
+package = types.ModuleType("bovine_filament_sensor")
+package.__path__ = [os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "..", "..", "bovine_filament_sensor")]
+sys.modules.setdefault("bovine_filament_sensor", package)
+from bovine_filament_sensor import telemetry  # noqa: E402
+
+DTYPE = np.dtype([("time", "<f8"), ("kind", "<u2"), ("arg", "<i2"),
+                  ("value", "<f4")])
+assert DTYPE.itemsize == telemetry.ENTRY.size
+
+# Extrusion rate bins of the gap table (mm/s)
+RATE_BINS = (0.05, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+
+def load(paths):
+    """Entries of all files and their source, the index of the directory
+    of their file, sorted by source and time, duplicates removed.
+
+    Ring files start with the ring header, ``getTelemetry`` answers are
+    bare entries. Overlapping dumps of the same ring are fine when they
+    are in the same directory.
+    """
+    arrays = []
+    sources = []
+    directories = {}
+    for path in paths:
+        directory = os.path.dirname(os.path.abspath(path))
+        source = directories.setdefault(directory, len(directories))
+        with open(path, "rb") as f:
+            data = f.read()
+        if data[:len(telemetry.MAGIC)] == telemetry.MAGIC:
+            data = data[telemetry.HEADER.size:]
+        usable = len(data) - len(data) % DTYPE.itemsize
+        entries = np.frombuffer(data[:usable], dtype=DTYPE)
+        # Unused ring slots have a time of 0
+        entries = entries[entries["time"] > 0]
+        arrays.append(entries)
+        sources.append(np.full(len(entries), source, dtype=np.int64))
+    if not arrays:
+        return np.empty(0, dtype=DTYPE), np.empty(0, dtype=np.int64)
+    entries = np.concatenate(arrays)
+    source = np.concatenate(sources)
+    # Sort by source and time, then by the rest of the entry, so that
+    # duplicates are neighbours
+    words = entries.view("<u8").reshape(-1, 2)
+    order = np.lexsort((words[:, 1], entries["time"], source))
+    entries, source = entries[order], source[order]
+    words = entries.view("<u8").reshape(-1, 2)
+    duplicate = (np.all(words[1:] == words[:-1], axis=1) &
+                 (source[1:] == source[:-1]))
+    keep = np.r_[True, ~duplicate]
+    return entries[keep], source[keep]
+
+
+class History:
+    """Edges and commanded filament of the recorded jobs.
+
+    Jobs start at the JOB_START entries, with each ``source`` (entries
+    sorted by source, then time), and at edge gaps longer than
+    ``max_gap`` (a ring that wrapped over the start of a job, a printer
+    left idle). Edges and filament are grouped by (job, tool).
+    """
+
+    def __init__(self, entries, max_gap, source=None):
+        kind = entries["kind"]
+        t = entries["time"]
+        is_edge = kind == telemetry.EDGE
+        if source is None:
+            source = np.zeros(len(t), dtype=np.int64)
+        started = np.cumsum((kind == telemetry.JOB_START) |
+                            np.r_[False, source[1:] != source[:-1]])
+        # Long edge gaps within a job split it, each entry follows the
+        # split of the last edge before it
+        split = np.zeros(len(t), dtype=bool)
+        edge_started = started[is_edge]
+        split[np.flatnonzero(is_edge)[1:]] = (
+            (np.diff(t[is_edge]) > max_gap) &
+            (edge_started[1:] == edge_started[:-1]))
+        self.breaks = int(split.sum())
+        job = started + np.cumsum(split)
+        if len(job):
+            # Entries before the first JOB_START make job 0
+            job -= job[0]
+        self.jobs = int(job[-1]) + 1 if len(job) else 0
+
+        # Time since the start of the job
+        start = np.full(self.jobs, np.inf)
+        first = np.r_[0, np.flatnonzero(np.diff(job)) + 1]
+        start[job[first]] = t[first]
+        offset = t - start[job]
+        span = float(offset.max()) + 1.0 if len(t) else 1.0
+        # One time axis for all (job, tool) groups, so that np.interp and
+        # np.searchsorted work on all of them at once: group * span +
+        # offset, with small group numbers to keep the precision
+        arg = entries["arg"].astype(np.int64) + 32768
+        used = np.bincount(arg, minlength=65536) > 0
+        rank = np.cumsum(used) - 1
+        group = job * int(used.sum()) + rank[arg]
+        key = group * span + offset
+        self.span = span
+
+        self.edge_key = key[is_edge]
+        self.edge_group = group[is_edge]
+        self.edge_job = job[is_edge]
+        self.edge_offset = offset[is_edge]
+        self.edge_step = entries["value"][is_edge].astype(np.float64)
+        # Entries are sorted by time, make them (group, time) sorted
+        order = np.argsort(self.edge_key, kind="stable")
+        for name in ("edge_key", "edge_group", "edge_job", "edge_offset",
+                     "edge_step"):
+            setattr(self, name, getattr(self, name)[order])
+
+        # Cumulative filament commanded per group. A flow monitor total
+        # starts again from 0 with each sensor start.
+        extruded = kind == telemetry.EXTRUDED
+        order = np.argsort(key[extruded], kind="stable")
+        self.ext_key = key[extruded][order]
+        self.ext_group = group[extruded][order]
+        value = entries["value"][extruded][order].astype(np.float64)
+        step = np.diff(value)
+        step = np.where(step < 0, value[1:], step)
+        step[self.ext_group[1:] != self.ext_group[:-1]] = 0.0
+        self.commanded = np.r_[0.0, np.cumsum(step)]
+
+        # Pause decisions, on a per job axis
+        pause = kind == telemetry.PAUSE
+        self.pause_key = np.sort(job[pause] * span + offset[pause])
+
+    def gaps(self):
+        """Gaps between consecutive edges of the same (job, tool).
+
+        Returns a dict of arrays: ``seconds``, ``job``, ``edges`` (edges
+        the gap stands for with downsampling), ``filament`` (commanded
+        during the gap, NaN without data) and ``legitimate``.
+        """
+        same = self.edge_group[1:] == self.edge_group[:-1]
+        begin = self.edge_key[:-1][same]
+        end = self.edge_key[1:][same]
+        group = self.edge_group[1:][same]
+        job = self.edge_job[1:][same]
+
+        # Filament: only where the group has commanded filament recorded
+        # around the whole gap
+        filament = np.full(len(begin), np.nan)
+        if len(self.ext_key):
+            groups, first = np.unique(self.ext_group, return_index=True)
+            last = np.r_[first[1:], len(self.ext_group)] - 1
+            n = np.minimum(np.searchsorted(groups, group), len(groups) - 1)
+            covered = ((groups[n] == group) &
+                       (self.ext_key[first[n]] <= begin) &
+                       (end <= self.ext_key[last[n]]))
+            delta = (np.interp(end, self.ext_key, self.commanded) -
+                     np.interp(begin, self.ext_key, self.commanded))
+            filament[covered] = delta[covered]
+
+        # A gap is not legitimate if a pause decision of its job falls in
+        job_begin = job * self.span + self.edge_offset[:-1][same]
+        job_end = job * self.span + self.edge_offset[1:][same]
+        paused = (np.searchsorted(self.pause_key, job_begin, side="right") <
+                  np.searchsorted(self.pause_key, job_end, side="right"))
+        return dict(seconds=end - begin, job=job, filament=filament,
+                    edges=self.edge_step[1:][same], legitimate=~paused)
+
+
+def per_job_max(values, job, jobs):
+    """Largest value of each job, 0 for jobs without any."""
+    result = np.zeros(jobs)
+    if len(values):
+        order = np.argsort(job, kind="stable")
+        job, values = job[order], values[order]
+        first = np.r_[0, np.flatnonzero(np.diff(job)) + 1]
+        result[job[first]] = np.maximum.reduceat(values, first)
+    return result
+
+
+def threshold(maxima, rate, margin):
+    """Smallest threshold over all but ``rate`` of the job maxima."""
+    return float(np.quantile(maxima, 1.0 - rate, method="higher")) * margin
+
+
+def rate_table(gaps):
+    seconds, filament = gaps["seconds"], gaps["filament"]
+    known = ~np.isnan(filament) & gaps["legitimate"]
+    rate = filament[known] / np.maximum(seconds[known], 1e-9)
+    seconds = seconds[known]
+    bins = np.digitize(rate, RATE_BINS)
+    labels = (["< %g" % RATE_BINS[0]] +
+              ["%g-%g" % pair for pair in zip(RATE_BINS, RATE_BINS[1:])] +
+              [">= %g" % RATE_BINS[-1]])
+    print("\nEdge gaps by extrusion rate")
+    print("  %10s %10s %9s %9s %9s" % ("mm/s", "gaps", "median", "p99.9",
+                                       "max"))
+    for n, label in enumerate(labels):
+        selected = seconds[bins == n]
+        if not len(selected):
+            continue
+        median, tail = np.quantile(selected, (0.5, 0.999))
+        print("  %10s %10d %8.3fs %8.3fs %8.3fs" % (
+            label, len(selected), median, tail, selected.max()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("files", nargs="+",
+                        help="telemetry.ring files or getTelemetry dumps")
+    parser.add_argument("--false-pause-rate", type=float, default=0.01,
+                        help="share of the jobs allowed to pause falsely "
+                             "(default 0.01)")
+    parser.add_argument("--margin", type=float, default=1.2,
+                        help="factor applied to the thresholds (default 1.2)")
+    parser.add_argument("--max-gap", type=float, default=1800.0,
+                        help="longer edge gaps split a job (default 1800 s)")
+    args = parser.parse_args(argv)
+    if not 0 <= args.false_pause_rate < 1:
+        parser.error("--false-pause-rate must be in [0, 1)")
+
+    started = time.perf_counter()
+    entries, source = load(args.files)
+    history = History(entries, args.max_gap, source)
+    gaps = history.gaps()
+    elapsed = time.perf_counter() - started
+
+    legitimate = gaps["legitimate"]
+    print("%d entries, %d jobs, %d edge gaps (%d around pauses) in %.2f s"
+          % (len(entries), history.jobs, len(legitimate),
+             np.count_nonzero(~legitimate), elapsed))
+    if history.breaks:
+        print("%d jobs split at gaps over %g s" % (history.breaks,
+                                                     args.max_gap))
+    if not np.any(legitimate):
+        print("No edges to tune from")
+        return 1
+    if np.any(gaps["edges"] > 1):
+        print("Downsampled history: the thresholds are conservative")
+    if history.jobs * args.false_pause_rate < 1:
+        print("Not enough jobs for that false pause rate: the thresholds "
+              "cover the worst job")
+
+    job = gaps["job"][legitimate]
+    seconds = gaps["seconds"][legitimate]
+    idle = per_job_max(seconds, job, history.jobs)
+    max_idle_time = max(np.ceil(threshold(idle, args.false_pause_rate,
+                                          args.margin)), 1.0)
+    print("\nLongest quiet window per job: median %.1f s, max %.1f s"
+          % (np.median(idle), idle.max()))
+    print("Recommended max_idle_time: %d s (%.1f%% of the jobs falsely "
+          "paused, detection after %d s)"
+          % (max_idle_time, 100.0 * np.mean(idle > max_idle_time),
+             max_idle_time))
+
+    filament = gaps["filament"][legitimate]
+    known = ~np.isnan(filament)
+    if not np.any(known):
+        print("\nNo commanded filament recorded: enable the distance or the "
+              "flow rate detection to tune detection_distance")
+        return 0
+    rate_table(gaps)
+
+    edges = gaps["edges"][legitimate][known]
+    mm_per_edge = filament[known].sum() / edges.sum()
+    print("\n%.3f edges per mm (%.4f mm per edge) over %.0f mm"
+          % (1 / mm_per_edge, mm_per_edge, filament[known].sum()))
+    distance = per_job_max(filament[known], job[known], history.jobs)
+    detection_distance = max(np.ceil(threshold(
+        distance, args.false_pause_rate, args.margin)), 1.0)
+    moving = known & (filament > 0)
+    speed = filament[moving].sum() / seconds[moving].sum()
+    print("Longest filament without an edge per job: median %.1f mm, "
+          "max %.1f mm" % (np.median(distance), distance.max()))
+    print("Recommended detection_distance: %d mm (%.1f%% of the jobs falsely "
+          "paused, detection after about %.0f s at %.2f mm/s)"
+          % (detection_distance,
+             100.0 * np.mean(distance > detection_distance),
+             detection_distance / speed, speed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())